@@ -0,0 +1,120 @@
+"""
+Semantic answer cache: reuses the answer to a previous question when a new
+question embeds within ANSWER_CACHE_MAX_DISTANCE (cosine) of it and was
+answered from exactly the same article sections. Only generic answers are
+shared between customers (see is_shareable).
+"""
+import os
+import re
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 500))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_MAX_DISTANCE = float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", 0.05))
+# control replies that act on the conversation they were given in
+CONTROL_WORDS = ["SKIP", "CLOSE"]
+# what could identify a customer: emails, anything with a digit, capitalized words
+PERSONAL_TOKEN_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+|\w*\d\w*|[A-Z]\w+")
+
+
+def is_shareable(answer, question, context):
+    """
+    Whether an answer to the question can be given to other customers: it isn't
+    a control reply and doesn't repeat anything personal-looking from the
+    question (a name, an email, an account number) that isn't in the context
+    """
+    content = answer.get("content") or ""
+    if any(word in content for word in CONTROL_WORDS):
+        return False
+    context = context.lower()
+    return not any(
+        token in content and token.lower() not in context
+        for token in set(PERSONAL_TOKEN_RE.findall(question))
+    )
+
+
+class AnswerCache:
+    def __init__(self, max_size, ttl, max_distance):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        # question embedding (normalized) -> checksums + answer, oldest first
+        self.entries = OrderedDict()
+        self.next_key = 0
+
+    def lookup(self, embedding, checksums):
+        self.expire()
+        if not self.entries:
+            metrics.increment("answer_cache_misses")
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        keys = list(self.entries)
+        matrix = np.stack([self.entries[key]["embedding"] for key in keys])
+        distances = 1 - matrix @ query
+        checksums = frozenset(checksums)
+        for i in np.argsort(distances):
+            if distances[i] > self.max_distance:
+                break
+            entry = self.entries[keys[i]]
+            # sections changed since (or different ones retrieved): not reusable
+            if entry["checksums"] != checksums:
+                continue
+            self.entries.move_to_end(keys[i])
+            metrics.increment("answer_cache_hits")
+            return dict(entry["answer"])
+        metrics.increment("answer_cache_misses")
+        return None
+
+    def store(self, embedding, checksums, answer):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.entries[self.next_key] = {
+            "embedding": embedding / (np.linalg.norm(embedding) or 1),
+            "checksums": frozenset(checksums),
+            "answer": dict(answer),
+            "created_at": time.time(),
+        }
+        self.next_key += 1
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def expire(self):
+        now = time.time()
+        for key in [
+            k for k, e in self.entries.items() if now - e["created_at"] > self.ttl
+        ]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def invalidate_sections(self, checksums):
+        """
+        Drop answers that were grounded on any of the given (changed) sections
+        """
+        checksums = set(checksums)
+        for key in [k for k, e in self.entries.items() if e["checksums"] & checksums]:
+            del self.entries[key]
+            metrics.increment("answer_cache_invalidations")
+
+    def retain_sections(self, checksums):
+        """
+        Drop answers grounded on sections that are no longer indexed, e.g. after
+        loading a new index snapshot
+        """
+        checksums = set(checksums)
+        self.invalidate_sections(
+            {c for e in self.entries.values() for c in e["checksums"]} - checksums
+        )
+
+
+answer_cache = AnswerCache(
+    ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_DISTANCE
+)
@@ -4,6 +4,7 @@ from chromadb.config import Settings
 from chromadb.utils import embedding_functions
 import openai
 from dotenv import load_dotenv
+from embeddings import EMBEDDINGS_BACKEND, EMBEDDINGS_MODEL
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -19,9 +20,14 @@ client_settings = Settings(
 )
 
 client = chromadb.Client(client_settings)
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.getenv("OPENAI_API_KEY"), model_name="text-embedding-ada-002"
-)
+if EMBEDDINGS_BACKEND == "local":
+    embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name=EMBEDDINGS_MODEL
+    )
+else:
+    embedding_function = embedding_functions.OpenAIEmbeddingFunction(
+        api_key=os.getenv("OPENAI_API_KEY"), model_name=EMBEDDINGS_MODEL
+    )
 collection = client.get_or_create_collection(
-    name="articles", embedding_function=openai_ef
+    name="articles", embedding_function=embedding_function
 )
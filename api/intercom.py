@@ -1,7 +1,7 @@
-import json
+import asyncio
 import os
+import aiohttp
 from dotenv import load_dotenv
-import requests
 from termcolor import cprint
 
 load_dotenv()
@@ -10,6 +10,9 @@ INTERCOM_ACCESS_TOKEN = os.getenv("INTERCOM_ACCESS_TOKEN")
 REPLY_ADMIN_ID = os.getenv("REPLY_ADMIN_ID")
 HUMAN_ASSIGNEE_ID = os.getenv("HUMAN_ASSIGNEE_ID", None)
 TEST_MODE = os.getenv("TEST_MODE", False)
+INTERCOM_TIMEOUT = float(os.getenv("INTERCOM_TIMEOUT", 30))
+INTERCOM_MAX_CONNECTIONS = int(os.getenv("INTERCOM_MAX_CONNECTIONS", 10))
+ARTICLES_PER_PAGE = 50
 
 
 headers = {
@@ -19,19 +22,72 @@ headers = {
 }
 
 
+# one keep-alive session per event loop, shared by all requests
+_session = None
+_session_loop = None
+_semaphore = None
+
+
+def get_session():
+    """
+    Returns the shared aiohttp session, creating it (and the concurrency limit)
+    on first use or when called from a new event loop
+    """
+    global _session, _session_loop, _semaphore
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=INTERCOM_MAX_CONNECTIONS)
+        _session = aiohttp.ClientSession(headers=headers, connector=connector)
+        _session_loop = loop
+        _semaphore = asyncio.Semaphore(INTERCOM_MAX_CONNECTIONS)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def request(method, url, payload=None):
+    session = get_session()
+    async with _semaphore:
+        async with session.request(
+            method,
+            url,
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=INTERCOM_TIMEOUT),
+        ) as response:
+            return await response.json(content_type=None)
+
+
 async def api_request(url="https://api.intercom.io/articles"):
-    response = requests.get(url, headers=headers)
-    json_response = json.loads(response.text)
-    return json_response
+    return await request("GET", url)
 
 
 async def get_all_articles():
-    articles = []
-    url = "https://api.intercom.io/articles"
-    while url:
-        json_response = await api_request(url)
+    """
+    Fetch the first page to learn the page count, then all others concurrently
+    """
+    url = f"https://api.intercom.io/articles?per_page={ARTICLES_PER_PAGE}"
+    json_response = await api_request(url)
+    articles = json_response["data"]
+    total_pages = json_response["pages"].get("total_pages")
+    if total_pages is None:
+        # no page count, follow the next links instead
+        next_url = json_response["pages"].get("next", None)
+        while next_url:
+            json_response = await api_request(next_url)
+            articles += json_response["data"]
+            next_url = json_response["pages"].get("next", None)
+        return articles
+
+    json_responses = await asyncio.gather(
+        *[api_request(f"{url}&page={page}") for page in range(2, total_pages + 1)]
+    )
+    for json_response in json_responses:
         articles += json_response["data"]
-        url = json_response["pages"].get("next", None)
     return articles
 
 
@@ -49,18 +105,12 @@ async def send_reply(conversation_id, message, message_type="comment"):
         "message_type": message_type if not TEST_MODE else "note",
         "body": message,
     }
-    response = requests.post(
-        url, headers=headers, json=payload
-    )  # returns the conversation
-    json_response = json.loads(response.text)
-    return json_response
+    return await request("POST", url, payload)  # returns the conversation
 
 
 async def manage_conversation(conversation_id, payload):
     url = f"https://api.intercom.io/conversations/{conversation_id}/parts"
-    response = requests.post(url, headers=headers, json=payload)
-    json_response = json.loads(response.text)
-    return json_response
+    return await request("POST", url, payload)
 
 
 async def unassign_conversation(conversation_id):
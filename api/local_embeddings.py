@@ -0,0 +1,43 @@
+import asyncio
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+from termcolor import cprint
+
+load_dotenv()
+
+LOCAL_EMBEDDINGS_MODEL = os.getenv(
+    "LOCAL_EMBEDDINGS_MODEL", "sentence-transformers/all-MiniLM-L6-v2"
+)
+LOCAL_EMBEDDINGS_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDINGS_BATCH_SIZE", 64))
+
+
+@lru_cache(maxsize=None)
+def get_model(model_name=LOCAL_EMBEDDINGS_MODEL):
+    # heavy import, only pay for it when the local backend is used
+    from sentence_transformers import SentenceTransformer
+
+    cprint(f"Loading embeddings model {model_name}", "blue")
+    return SentenceTransformer(model_name, device="cpu")
+
+
+def get_embeddings_sync(texts, model_name=LOCAL_EMBEDDINGS_MODEL):
+    return get_model(model_name).encode(
+        texts,
+        batch_size=LOCAL_EMBEDDINGS_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+
+
+async def get_embeddings(texts, model_name=LOCAL_EMBEDDINGS_MODEL):
+    # torch releases the GIL, so a thread keeps the event loop responsive
+    return list(await asyncio.to_thread(get_embeddings_sync, texts, model_name))
+
+
+def warm_up(model_name=LOCAL_EMBEDDINGS_MODEL):
+    """
+    Load the model and run it once, so the first question isn't slow
+    """
+    get_embeddings_sync(["warm up"], model_name)
@@ -1,11 +1,16 @@
+import asyncio
+import json
+from functools import lru_cache
+import random
 import time
 import openai
+import tiktoken
 import os
 from dotenv import load_dotenv
 from termcolor import cprint
-import requests
 
 from functions import functions
+import metrics
 
 load_dotenv()
 
@@ -13,6 +18,187 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 OPENAI_EMBEDDINGS_MODEL = os.getenv("OPENAI_EMBEDDINGS_MODEL", "text-embedding-ada-002")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 OPENAI_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", 0.25))
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", 5))
+OPENAI_RETRY_BUDGET = float(os.getenv("OPENAI_RETRY_BUDGET", 20))
+OPENAI_RETRY_BUDGET_REFILL = float(os.getenv("OPENAI_RETRY_BUDGET_REFILL", 1))
+OPENAI_EMBEDDINGS_BATCH_TOKENS = int(os.getenv("OPENAI_EMBEDDINGS_BATCH_TOKENS", 50000))
+OPENAI_EMBEDDINGS_BATCH_SIZE = int(os.getenv("OPENAI_EMBEDDINGS_BATCH_SIZE", 500))
+OPENAI_EMBEDDINGS_CONCURRENCY = int(os.getenv("OPENAI_EMBEDDINGS_CONCURRENCY", 4))
+# tokens kept free for the reply
+OPENAI_RESPONSE_TOKENS = int(os.getenv("OPENAI_RESPONSE_TOKENS", 1000))
+CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# read completions as they are generated, to act on SKIP/function calls early
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "true").lower() == "true"
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+
+class RetryBudget:
+    """
+    Token bucket shared by all requests, so a burst of rate limit errors
+    doesn't turn into a retry storm. Also remembers the latest Retry-After so
+    every request backs off, not just the one that got the error.
+    """
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.not_before = 0
+
+    def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.refill_per_second,
+        )
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def defer(self, seconds):
+        self.not_before = max(self.not_before, time.monotonic() + seconds)
+
+    async def wait(self):
+        delay = self.not_before - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+retry_budget = RetryBudget(OPENAI_RETRY_BUDGET, OPENAI_RETRY_BUDGET_REFILL)
+
+
+def get_retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+async def create_with_retries(create, **kwargs):
+    """
+    Await an OpenAI acreate call, retrying retryable errors with backoff until
+    OPENAI_MAX_ATTEMPTS or the shared retry budget runs out (then re-raises)
+    """
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        await retry_budget.wait()
+        try:
+            return await create(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            cprint(f"{e}", "red")
+            if attempt + 1 == OPENAI_MAX_ATTEMPTS or not retry_budget.acquire():
+                raise
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                # every request waits this out before its next attempt
+                retry_budget.defer(retry_after)
+            else:
+                await asyncio.sleep(get_backoff(attempt))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model=OPENAI_EMBEDDINGS_MODEL):
+    return len(get_encoding(model).encode(text))
+
+
+def count_message_tokens(messages, model=OPENAI_MODEL, functions=None):
+    """
+    Tokens the messages (and function definitions) take up in the prompt
+    """
+    # every message is wrapped in a few tokens, and the reply is primed with 3
+    tokens = 3
+    for message in messages:
+        tokens += 4 + count_tokens(message.get("content") or "", model)
+    if functions:
+        # close enough, the exact format the api uses isn't documented
+        tokens += count_tokens(json.dumps(functions), model)
+    return tokens
+
+
+def get_context_window(model=OPENAI_MODEL):
+    # longest matching prefix, e.g. gpt-4-0613 -> gpt-4
+    for prefix in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(prefix):
+            return CONTEXT_WINDOWS[prefix]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def make_batches(texts, max_tokens, max_size, model=OPENAI_EMBEDDINGS_MODEL):
+    """
+    Split texts into batches (lists of indices) of at most max_size texts
+    and max_tokens tokens
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text, model)
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) == max_size):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def get_embeddings(texts, model=OPENAI_EMBEDDINGS_MODEL):
+    """
+    Embed many texts with as few requests as possible: texts are packed into
+    token-bounded batches, and up to OPENAI_EMBEDDINGS_CONCURRENCY batches are
+    in flight at once. Returns the embeddings in the order of texts.
+    """
+    texts = [text.replace("\n", " ") for text in texts]
+    embeddings = [None] * len(texts)
+    semaphore = asyncio.Semaphore(OPENAI_EMBEDDINGS_CONCURRENCY)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            response = await create_with_retries(
+                openai.Embedding.acreate,
+                input=[texts[i] for i in batch],
+                model=model,
+            )
+        for data in response["data"]:
+            embeddings[batch[data["index"]]] = data["embedding"]
+
+    batches = make_batches(
+        texts, OPENAI_EMBEDDINGS_BATCH_TOKENS, OPENAI_EMBEDDINGS_BATCH_SIZE, model
+    )
+    await asyncio.gather(*[embed_batch(batch) for batch in batches])
+    return embeddings
 
 
 def get_embedding(text, model=OPENAI_EMBEDDINGS_MODEL):
@@ -20,29 +206,86 @@ def get_embedding(text, model=OPENAI_EMBEDDINGS_MODEL):
     return openai.Embedding.create(input=[text], model=model)["data"][0]["embedding"]
 
 
-def get_chat_completion(
+async def get_embedding_async(text, model=OPENAI_EMBEDDINGS_MODEL):
+    text = text.replace("\n", " ")
+    response = await openai.Embedding.acreate(input=[text], model=model)
+    return response["data"][0]["embedding"]
+
+
+async def read_stream(response, on_function_call=None):
+    """
+    Assemble a streamed chat completion into a message. Stops reading as soon
+    as the content says SKIP (the reply is dropped anyway), and calls
+    on_function_call(name) as soon as the function name is known, while the
+    rest of the completion is still coming.
+    """
+    start = time.perf_counter()
+    role = "assistant"
+    content = ""
+    function_call = None
+    async for chunk in response:
+        delta = chunk["choices"][0]["delta"]
+        role = delta.get("role", role)
+        content += delta.get("content") or ""
+        if "SKIP" in content:
+            metrics.increment("completion_streams_skipped")
+            metrics.observe("completion_time_to_action", time.perf_counter() - start)
+            await response.aclose()
+            break
+        if "function_call" in delta:
+            started = function_call is not None
+            function_call = function_call or {"name": "", "arguments": ""}
+            for key, value in delta["function_call"].items():
+                function_call[key] += value or ""
+            # the name comes in the first function call chunk
+            if on_function_call and not started:
+                metrics.observe(
+                    "completion_time_to_action", time.perf_counter() - start
+                )
+                on_function_call(function_call["name"])
+    metrics.observe("completion_stream_time", time.perf_counter() - start)
+    message = {"role": role, "content": content}
+    if function_call:
+        message["content"] = content or None
+        message["function_call"] = function_call
+    return message
+
+
+async def create_streamed_chat_completion(on_function_call=None, **kwargs):
+    response = await openai.ChatCompletion.acreate(stream=True, **kwargs)
+    message = await read_stream(response, on_function_call)
+    # same shape as a regular completion
+    return {"choices": [{"message": message}]}
+
+
+async def get_chat_completion(
     messages,
     model=OPENAI_MODEL,
     temperature=OPENAI_TEMPERATURE,
     functions=functions,
     function_call=None,
+    stream=OPENAI_STREAM,
+    on_function_call=None,
 ):
+    """
+    With stream, on_function_call(name) is called as soon as the model starts
+    a function call (see read_stream)
+    """
     kwargs = {"model": model, "messages": messages, "temperature": temperature}
     if functions is not None:
         kwargs.update({"functions": functions})
     if function_call is not None:
         kwargs.update({"function_call": function_call})
-    attempts = 0
-    while attempts < 5:
-        try:
-            response = openai.ChatCompletion.create(**kwargs)
-        except (openai.error.RateLimitError, openai.error.APIError) as e:
-            cprint("{e}", "red")
-            # wait 5 seconds and try again
-            time.sleep(5)
-            attempts += 1
-            continue
-        break
+    if stream:
+        create = create_streamed_chat_completion
+        kwargs.update({"on_function_call": on_function_call})
+    else:
+        create = openai.ChatCompletion.acreate
+    try:
+        response = await create_with_retries(create, **kwargs)
+    except RETRYABLE_ERRORS:
+        cprint("Giving up on OpenAI request", "red")
+        response = {}
     try:
         chat_completion = response["choices"][0]["message"]
     except KeyError:
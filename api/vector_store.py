@@ -0,0 +1,475 @@
+import json
+import os
+import shutil
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import numpy as np
+from dotenv import load_dotenv
+
+from lexical_index import BM25Index
+
+load_dotenv()
+
+# "numpy" (default) or "chroma"
+VECTOR_STORE = os.getenv("VECTOR_STORE", "numpy")
+
+# Get the absolute path of the current script
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Construct the absolute path of the .vectors directory
+persist_directory = os.path.join(script_dir, "..", ".vectors")
+
+# older snapshots are removed, readers switch to the new one on refresh
+INDEX_SNAPSHOTS_KEEP = max(2, int(os.getenv("INDEX_SNAPSHOTS_KEEP", 3)))
+
+
+def as_list(value):
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        embeddings = embeddings.reshape(1, -1)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+class StringColumn:
+    """
+    Read-only list of JSON values (documents, metadatas) stored back to back in
+    a memory-mapped file, so all processes reading the index share its pages
+    """
+
+    def __init__(self, path):
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        if self.offsets[-1]:
+            self.data = np.memmap(path + ".bin", dtype=np.uint8, mode="r")
+        else:
+            # can't mmap an empty file
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return json.loads(self.data[start:end].tobytes())
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+    @staticmethod
+    def write(path, values):
+        encoded = [json.dumps(value).encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        with open(path + ".bin", "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(path + ".offsets.npy", offsets)
+
+
+class NumpyCollection:
+    """
+    Minimal drop-in for the Chroma collection we use (add/update/get/delete/query).
+    Embeddings live in one contiguous float32 matrix with normalized rows, which
+    is memory-mapped from disk, so a query is a single matrix-vector product.
+    Distances are cosine distances (1 - cosine similarity).
+
+    Every persist writes a new snapshot directory and then points CURRENT to it.
+    Readers (e.g. several server workers) memory-map the current snapshot
+    read-only, so the index is in memory once however many there are, and
+    switch to a new one on refresh. The BM25 index of the sections is part of
+    the snapshot, so both always match.
+    """
+
+    def __init__(self, persist_directory, embedding_function=None):
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.current_path = os.path.join(persist_directory, "CURRENT")
+        self.snapshots_directory = os.path.join(persist_directory, "snapshots")
+        self.deferred = False
+        self.dirty = False
+        self.load()
+
+    def get_current_version(self):
+        try:
+            with open(self.current_path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        for attempt in range(3):
+            try:
+                self.current_mtime = (
+                    os.stat(self.current_path).st_mtime_ns
+                    if os.path.exists(self.current_path)
+                    else None
+                )
+                version = self.get_current_version()
+                if version is None:
+                    self.load_legacy()
+                else:
+                    self.load_snapshot(version)
+                break
+            except FileNotFoundError:
+                # the snapshot was pruned while loading, there's a newer one
+                if attempt == 2:
+                    raise
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        # metadata key -> value -> positions, built on the first filter by the key
+        self.where_index = {}
+
+    def load_snapshot(self, version):
+        snapshot_directory = os.path.join(self.snapshots_directory, str(version))
+        with open(os.path.join(snapshot_directory, "index.json")) as f:
+            index = json.load(f)
+        self.embeddings = np.load(
+            os.path.join(snapshot_directory, "embeddings.npy"), mmap_mode="r"
+        )
+        self.documents = StringColumn(os.path.join(snapshot_directory, "documents"))
+        self.metadatas = StringColumn(os.path.join(snapshot_directory, "metadatas"))
+        self.version = version
+        # collection metadata, e.g. the embeddings model the index was built with
+        self.metadata = index["metadata"]
+        self.ids = index["ids"]
+        lexical_index_path = os.path.join(snapshot_directory, "bm25.json")
+        self.lexical_index = (
+            BM25Index.load(lexical_index_path)
+            if os.path.exists(lexical_index_path)
+            else None
+        )
+
+    def load_legacy(self):
+        """
+        Indexes from before snapshots: index.json (with the documents and
+        metadatas) and the embeddings file right in persist_directory
+        """
+        index_path = os.path.join(self.persist_directory, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            self.embeddings = np.load(
+                os.path.join(
+                    self.persist_directory,
+                    index.get("embeddings_file", "embeddings.npy"),
+                ),
+                mmap_mode="r",
+            )
+        else:
+            self.embeddings = np.zeros((0, 0), dtype=np.float32)
+            index = {"ids": [], "documents": [], "metadatas": []}
+        self.version = index.get("version", 0)
+        self.metadata = index.get("metadata", {})
+        self.ids = index["ids"]
+        self.documents = index["documents"]
+        self.metadatas = index["metadatas"]
+        self.lexical_index = None
+
+    def refresh(self):
+        """
+        Load the current snapshot if another process (the indexer) wrote a new one
+        returns whether it was reloaded
+        """
+        try:
+            mtime = os.stat(self.current_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.current_mtime or self.get_current_version() == self.version:
+            self.current_mtime = mtime
+            return False
+        self.load()
+        return True
+
+    def make_writable(self):
+        # the loaded columns are read-only views of the snapshot, copy them
+        if not isinstance(self.documents, list):
+            self.documents = list(self.documents)
+            self.metadatas = list(self.metadatas)
+
+    def get_snapshot_versions(self):
+        if not os.path.isdir(self.snapshots_directory):
+            return []
+        return sorted(
+            int(name) for name in os.listdir(self.snapshots_directory) if name.isdigit()
+        )
+
+    def persist(self):
+        if self.deferred:
+            self.dirty = True
+            return
+        version = max([self.version, *self.get_snapshot_versions()]) + 1
+        # write to a temp directory first so a crash never leaves a half-written
+        # snapshot
+        tmp_directory = os.path.join(self.snapshots_directory, f"tmp-{os.getpid()}")
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        np.save(
+            os.path.join(tmp_directory, "embeddings.npy"),
+            np.ascontiguousarray(self.embeddings, dtype=np.float32),
+        )
+        StringColumn.write(os.path.join(tmp_directory, "documents"), self.documents)
+        StringColumn.write(os.path.join(tmp_directory, "metadatas"), self.metadatas)
+        if self.lexical_index is not None:
+            self.lexical_index.save(os.path.join(tmp_directory, "bm25.json"))
+        with open(os.path.join(tmp_directory, "index.json"), "w") as f:
+            json.dump(
+                {"version": version, "ids": self.ids, "metadata": self.metadata}, f
+            )
+        os.rename(tmp_directory, os.path.join(self.snapshots_directory, str(version)))
+
+        # the new version goes live all at once, with this rename
+        tmp_current_path = self.current_path + ".tmp"
+        with open(tmp_current_path, "w") as f:
+            f.write(str(version))
+        os.replace(tmp_current_path, self.current_path)
+
+        self.prune_snapshots()
+        self.load()
+
+    def prune_snapshots(self):
+        """
+        Remove all but the last INDEX_SNAPSHOTS_KEEP snapshots (readers may still
+        be loading the previous ones) and the pre-snapshot index files
+        """
+        for version in self.get_snapshot_versions()[:-INDEX_SNAPSHOTS_KEEP]:
+            shutil.rmtree(
+                os.path.join(self.snapshots_directory, str(version)), ignore_errors=True
+            )
+        for name in os.listdir(self.persist_directory):
+            if name == "index.json" or (
+                name.startswith("embeddings") and name.endswith(".npy")
+            ):
+                os.remove(os.path.join(self.persist_directory, name))
+
+    @contextmanager
+    def deferred_persist(self):
+        """
+        Persist once at the end instead of after every change, so other
+        processes only ever see the index before or after all of them
+        (and none of them if something fails)
+        """
+        self.deferred = True
+        try:
+            yield
+        except BaseException:
+            # keep the index as it was
+            self.deferred = self.dirty = False
+            self.load()
+            raise
+        self.deferred = False
+        if self.dirty:
+            self.dirty = False
+            self.persist()
+
+    def modify(self, metadata=None):
+        if metadata is not None:
+            self.metadata = metadata
+            self.persist()
+
+    def set_lexical_index(self, lexical_index):
+        self.lexical_index = lexical_index
+        self.persist()
+
+    def count(self):
+        return len(self.ids)
+
+    def embed(self, texts):
+        if self.embedding_function is None:
+            raise ValueError("No embedding function to embed query_texts with")
+        return self.embedding_function(texts)
+
+    def add(self, ids, embeddings=None, documents=None, metadatas=None):
+        self.make_writable()
+        ids = as_list(ids)
+        documents = as_list(documents) or [None] * len(ids)
+        metadatas = as_list(metadatas) or [None] * len(ids)
+        if embeddings is None:
+            embeddings = self.embed(documents)
+        embeddings = normalize(embeddings)
+
+        # adding an existing id replaces it
+        existing = [id for id in ids if id in self.positions]
+        if existing:
+            self.remove(existing)
+
+        start = len(self.ids)
+        for key, index in self.where_index.items():
+            for position, metadata in enumerate(metadatas, start):
+                if metadata and key in metadata:
+                    index[metadata[key]].append(position)
+        self.positions.update((id, position) for position, id in enumerate(ids, start))
+        if self.embeddings.size:
+            self.embeddings = np.concatenate([self.embeddings, embeddings])
+        else:
+            self.embeddings = embeddings
+        self.ids += ids
+        self.documents += documents
+        self.metadatas += metadatas
+        self.persist()
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None):
+        self.make_writable()
+        ids = as_list(ids)
+        embeddings = None if embeddings is None else normalize(embeddings)
+        documents = as_list(documents)
+        metadatas = as_list(metadatas)
+        if embeddings is not None and not self.embeddings.flags.writeable:
+            # copy the memory-mapped snapshot once, not on every update
+            self.embeddings = np.array(self.embeddings)
+        for i, id in enumerate(ids):
+            position = self.positions.get(id)
+            if position is None:
+                continue
+            if embeddings is not None:
+                self.embeddings[position] = embeddings[i]
+            if documents is not None:
+                self.documents[position] = documents[i]
+            if metadatas is not None:
+                self.metadatas[position] = metadatas[i]
+        if metadatas is not None:
+            self.where_index = {}
+        self.persist()
+
+    def match(self, ids=None, where=None):
+        """
+        Returns the positions of entries matching the ids and where filter
+        (only simple equality filters, e.g. {"article_id": 123})
+        """
+        if not where:
+            if ids is None:
+                return list(range(len(self.ids)))
+            return [self.positions[id] for id in as_list(ids) if id in self.positions]
+        (key, value), *rest = where.items()
+        positions = self.get_where_index(key).get(value, [])
+        if rest:
+            positions = [
+                p
+                for p in positions
+                if all(self.metadatas[p].get(k) == v for k, v in rest)
+            ]
+        if ids is not None:
+            matches = set(positions)
+            positions = [
+                self.positions[id]
+                for id in as_list(ids)
+                if self.positions.get(id) in matches
+            ]
+        return list(positions)
+
+    def get_where_index(self, key):
+        """
+        Positions of the entries by their value of a metadata key, so filtering
+        by it (e.g. diffing every article's sections) doesn't scan the index
+        """
+        index = self.where_index.get(key)
+        if index is None:
+            index = defaultdict(list)
+            for position, metadata in enumerate(self.metadatas):
+                if metadata and key in metadata:
+                    index[metadata[key]].append(position)
+            self.where_index[key] = index
+        return index
+
+    def get(self, ids=None, where=None, include=["metadatas", "documents"]):
+        positions = self.match(ids, where)
+        return {
+            "ids": [self.ids[p] for p in positions],
+            "embeddings": self.embeddings[positions].tolist()
+            if "embeddings" in include
+            else None,
+            "documents": [self.documents[p] for p in positions]
+            if "documents" in include
+            else None,
+            "metadatas": [self.metadatas[p] for p in positions]
+            if "metadatas" in include
+            else None,
+        }
+
+    def remove(self, ids):
+        self.make_writable()
+        removed = {self.positions[id] for id in ids if id in self.positions}
+        keep = [p for p in range(len(self.ids)) if p not in removed]
+        self.embeddings = self.embeddings[keep]
+        self.ids = [self.ids[p] for p in keep]
+        self.documents = [self.documents[p] for p in keep]
+        self.metadatas = [self.metadatas[p] for p in keep]
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self.where_index = {}
+
+    def delete(self, ids=None, where=None):
+        deleted_ids = [self.ids[p] for p in self.match(ids, where)]
+        if deleted_ids:
+            self.remove(deleted_ids)
+            self.persist()
+        return deleted_ids
+
+    def query(
+        self,
+        query_embeddings=None,
+        query_texts=None,
+        n_results=10,
+        where=None,
+        include=["metadatas", "documents", "distances"],
+    ):
+        if query_embeddings is None:
+            query_embeddings = self.embed(as_list(query_texts))
+        queries = normalize(query_embeddings)
+
+        candidates = np.array(self.match(where=where) if where else [], dtype=int)
+        matrix = self.embeddings[candidates] if where else self.embeddings
+
+        results = {
+            "ids": [],
+            "embeddings": [],
+            "documents": [],
+            "metadatas": [],
+            "distances": [],
+        }
+        for query in queries:
+            k = min(n_results, len(matrix))
+            if k == 0:
+                top = np.array([], dtype=int)
+                similarities = np.array([], dtype=np.float32)
+            else:
+                similarities = matrix @ query
+                # top k without sorting everything, then sort just those
+                top = np.argpartition(-similarities, k - 1)[:k]
+                top = top[np.argsort(-similarities[top])]
+            positions = candidates[top] if where else top
+            results["ids"].append([self.ids[p] for p in positions])
+            if "embeddings" in include:
+                # rows of the matrix, no need to convert them to lists
+                results["embeddings"].append(list(self.embeddings[positions]))
+            results["documents"].append([self.documents[p] for p in positions])
+            results["metadatas"].append([self.metadatas[p] for p in positions])
+            results["distances"].append((1 - similarities[top]).tolist())
+        for key in ["embeddings", "documents", "metadatas", "distances"]:
+            if key not in include:
+                results[key] = None
+        return results
+
+
+def deferred_persist(collection):
+    if isinstance(collection, NumpyCollection):
+        return collection.deferred_persist()
+    # chroma persists on its own
+    return nullcontext()
+
+
+def get_collection():
+    if VECTOR_STORE == "chroma":
+        from api.chroma import collection
+
+        return collection
+
+    from embeddings import get_embeddings_sync
+
+    return NumpyCollection(persist_directory, embedding_function=get_embeddings_sync)
+
+
+collection = get_collection()
@@ -0,0 +1,138 @@
+"""
+Micro-benchmark of the HTML cleaning in html_cleaning against the previous
+BeautifulSoup (html.parser) implementation. Uses the articles in
+articles.db if there are any, sample HTML otherwise.
+
+python benchmark_html_cleaning.py --number 200
+"""
+import argparse
+import os
+import sqlite3
+import timeit
+from bs4 import BeautifulSoup, NavigableString
+
+from html_cleaning import (
+    clean_part,
+    clean_section,
+    part_cache,
+    strip_patterns,
+    wrap_paragraphs,
+)
+
+DIVIDER = "<p>_____</p>"
+NOTICE_INNER = "NOTE: Bot is our experimental AI chatbot. It may not always provide a correct answer. A human will follow up if needed."
+NOTICE = f"{DIVIDER}<p><i>{NOTICE_INNER}</i></p>"
+
+SAMPLE_PARTS = [
+    "Hi, I can't log in to my account, it says my password is wrong.",
+    "<p>Thanks! I tried that but <b>it still fails</b>.</p><p>Any ideas?</p>",
+    "<p>You can reset your password from the <a href='https://example.com/reset'>login page</a>.</p>"
+    + NOTICE,
+    "Sure, here's a screenshot<br><img src='https://example.com/a.png'>",
+]
+SAMPLE_SECTIONS = [
+    "<h2 id='setup' class='intercom-align-left'>Setting up</h2>\n"
+    + "<p class='no-margin'>Go to <b>Settings</b> and click <i>Connect</i>.</p>\n<p class='no-margin'></p>\n"
+    * 10,
+    "<h3>Billing</h3><ul><li><p>Invoices</p></li><li><p>Refunds</p></li></ul><p><br></p>",
+    "<p>Watch the video<!-- embed --> below</p>"
+    + "<iframe src='https://example.com/v' allowfullscreen></iframe>"
+    + "<p><img src='https://example.com/a.png' alt='Settings'></p>"
+    + "<input type='checkbox' checked disabled>",
+]
+
+
+def old_wrap_paragraphs(html):
+    soup = BeautifulSoup(html, "html.parser")
+    inline_elements = ["a", "em", "strong", "span", "b", "i", "code"]
+
+    def wrap_text_and_inline_in_p(tag):
+        current_paragraph = None
+        for content in list(tag.contents):
+            if (isinstance(content, NavigableString) and content.string.strip()) or (
+                content.name in inline_elements
+            ):
+                if current_paragraph is None:
+                    current_paragraph = soup.new_tag("p")
+                    content.insert_before(current_paragraph)
+                current_paragraph.append(content)
+            else:
+                current_paragraph = None
+
+    wrap_text_and_inline_in_p(soup)
+    return str(soup)
+
+
+def old_clean_part(part):
+    body = part["body"].replace(NOTICE, "")
+    body = body.replace(DIVIDER, "")
+    body = body.replace(NOTICE_INNER, "")
+    return old_wrap_paragraphs(body)
+
+
+def old_clean_section(html):
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup():
+        if "class" in tag.attrs:
+            del tag.attrs["class"]
+        if "id" in tag.attrs:
+            del tag.attrs["id"]
+    for p in soup.find_all("p"):
+        if not p.get_text(strip=True):
+            p.decompose()
+    return "".join(line.strip() for line in str(soup).split("\n"))
+
+
+def load_sections():
+    if not os.path.exists("articles.db"):
+        return SAMPLE_SECTIONS
+    with sqlite3.connect("articles.db") as db:
+        rows = db.execute("SELECT body FROM articles WHERE body != ''").fetchall()
+    return [row[0] for row in rows] or SAMPLE_SECTIONS
+
+
+def bench(name, function, items, number):
+    seconds = timeit.timeit(lambda: [function(item) for item in items], number=number)
+    per_item = seconds / number / len(items) * 1e6
+    print(f"{name:<40} {per_item:10.1f} µs/item")
+    return per_item
+
+
+def main(number):
+    notice_re = strip_patterns(NOTICE, DIVIDER, NOTICE_INNER)
+    parts = [{"id": str(i), "body": body} for i, body in enumerate(SAMPLE_PARTS)]
+    sections = load_sections()
+
+    mismatches = sum(old_clean_section(s) != clean_section(s) for s in sections)
+    mismatches += sum(
+        old_clean_part(p) != wrap_paragraphs(notice_re.sub("", p["body"]))
+        for p in parts
+    )
+    print(f"{len(parts)} parts, {len(sections)} sections, {mismatches} mismatches\n")
+
+    old = bench("conversation parts (BeautifulSoup)", old_clean_part, parts, number)
+    new = bench(
+        "conversation parts (lxml)",
+        lambda p: wrap_paragraphs(notice_re.sub("", p["body"])),
+        parts,
+        number,
+    )
+    part_cache.clear()
+    cached = bench(
+        "conversation parts (memoized)",
+        lambda p: clean_part(p, strip=notice_re),
+        parts,
+        number,
+    )
+    print(f"speedup {old / new:.1f}x, memoized {old / cached:.0f}x\n")
+
+    old = bench("sections (BeautifulSoup)", old_clean_section, sections, number)
+    new = bench("sections (lxml)", clean_section, sections, number)
+    print(f"speedup {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+    main(args.number)
@@ -1,5 +1,5 @@
 from termcolor import cprint
-from api.chroma import collection
+from api.vector_store import collection
 from make_embeddings import Article, Section, collection, session_scope
 
 
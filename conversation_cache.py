@@ -0,0 +1,82 @@
+"""
+Per-conversation transcript cache: the conversation parts seen so far, kept up
+to date from webhook payloads and reply responses, so a reply only needs a full
+conversation fetch when the cache has a gap (a part we haven't seen)
+"""
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", 1000))
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", 60 * 60))
+
+
+class ConversationCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # conversation id -> parts in order, least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, conversation_id, total_count=None, last_part_id=None):
+        """
+        Returns the cached parts of the conversation, None if not cached or if
+        they don't match the given part count and latest part (e.g. the cache
+        is behind a webhook another worker process received)
+        """
+        entry = self.entries.get(conversation_id)
+        if entry is None or time.time() - entry["updated_at"] > self.ttl:
+            self.entries.pop(conversation_id, None)
+            metrics.increment("conversation_cache_misses")
+            return None
+        parts = entry["parts"]
+        if (total_count is not None and len(parts) != total_count) or (
+            last_part_id is not None and (not parts or parts[-1]["id"] != last_part_id)
+        ):
+            metrics.increment("conversation_cache_stale")
+            return None
+        self.entries.move_to_end(conversation_id)
+        metrics.increment("conversation_cache_hits")
+        return list(entry["parts"])
+
+    def store(self, conversation_id, parts):
+        """
+        Replace the cached parts, e.g. with a freshly fetched conversation
+        """
+        self.entries[conversation_id] = {
+            "parts": list(parts),
+            "part_ids": {part["id"] for part in parts},
+            "updated_at": time.time(),
+        }
+        self.entries.move_to_end(conversation_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def update(self, conversation_id, parts, total_count):
+        """
+        Add the parts we haven't seen yet. Webhooks and replies only carry the
+        latest parts, so if that doesn't add up to total_count some are missing
+        and the conversation is dropped (to be fetched in full when needed).
+        returns whether the cached conversation is complete
+        """
+        entry = self.entries.get(conversation_id)
+        if entry is None or time.time() - entry["updated_at"] > self.ttl:
+            entry = {"parts": [], "part_ids": set()}
+        new_parts = [part for part in parts if part["id"] not in entry["part_ids"]]
+        if len(entry["parts"]) + len(new_parts) != total_count:
+            self.entries.pop(conversation_id, None)
+            metrics.increment("conversation_cache_gaps")
+            return False
+        self.store(conversation_id, entry["parts"] + new_parts)
+        return True
+
+    def clear(self):
+        self.entries.clear()
+
+
+conversation_cache = ConversationCache(CONVERSATION_CACHE_SIZE, CONVERSATION_CACHE_TTL)
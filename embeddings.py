@@ -0,0 +1,200 @@
+"""
+Embeddings from the configured backend: the OpenAI API or a local
+sentence-transformers model. Query embeddings are cached in memory (LRU + TTL)
+and optionally in SQLite, so repeat questions don't pay for an embeddings call,
+even after a restart.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+import metrics
+from api import local_embeddings
+from api.openai import (
+    OPENAI_EMBEDDINGS_MODEL,
+    get_embedding,
+    get_embedding_async,
+    get_embeddings,
+)
+
+load_dotenv()
+
+# "openai" (default) or "local" (sentence-transformers on the CPU, no API calls)
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "openai")
+EMBEDDINGS_MODEL = (
+    local_embeddings.LOCAL_EMBEDDINGS_MODEL
+    if EMBEDDINGS_BACKEND == "local"
+    else OPENAI_EMBEDDINGS_MODEL
+)
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 1000))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 60 * 60))
+# e.g. embedding_cache.db, leave unset to only cache in memory
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB")
+EMBEDDING_CACHE_DB_SIZE = int(os.getenv("EMBEDDING_CACHE_DB_SIZE", 100000))
+# expired and least recently used rows are deleted every this many writes
+EMBEDDING_CACHE_DB_SWEEP_EVERY = 100
+
+
+def normalize_text(text):
+    # case, whitespace and trailing punctuation don't change the question
+    return " ".join(text.lower().split()).strip(" ?!.")
+
+
+class EmbeddingCache:
+    def __init__(
+        self, max_size, ttl, db_path=None, db_max_size=EMBEDDING_CACHE_DB_SIZE
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.db_max_size = db_max_size
+        self.db_writes = 0
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(key TEXT PRIMARY KEY, embedding BLOB, created_at REAL, used_at REAL)"
+            )
+            columns = [
+                row[1] for row in self.db.execute("PRAGMA table_info(query_embeddings)")
+            ]
+            if "used_at" not in columns:
+                self.db.execute("ALTER TABLE query_embeddings ADD COLUMN used_at REAL")
+                self.db.execute("UPDATE query_embeddings SET used_at = created_at")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS ix_query_embeddings_used_at "
+                "ON query_embeddings (used_at)"
+            )
+            self.sweep_db()
+
+    def get_key(self, text, model):
+        normalized = normalize_text(text)
+        return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, text, model):
+        key = self.get_key(text, model)
+        embedding = self.get_memory(key)
+        if embedding is None:
+            embedding = self.get_db(key)
+        if embedding is None:
+            self.misses += 1
+            metrics.increment("embedding_cache_misses")
+        else:
+            self.hits += 1
+            metrics.increment("embedding_cache_hits")
+        return embedding
+
+    def get_memory(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        embedding, created_at = entry
+        if time.time() - created_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return embedding
+
+    def get_db(self, key):
+        if self.db is None:
+            return None
+        row = self.db.execute(
+            "SELECT embedding, created_at FROM query_embeddings WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            if time.time() - row[1] > self.ttl:
+                self.db.execute("DELETE FROM query_embeddings WHERE key = ?", (key,))
+                return None
+            self.db.execute(
+                "UPDATE query_embeddings SET used_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+        self.set_memory(key, embedding, row[1])
+        return embedding
+
+    def set(self, text, model, embedding):
+        key = self.get_key(text, model)
+        created_at = time.time()
+        self.set_memory(key, embedding, created_at)
+        if self.db is not None:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+                    (
+                        key,
+                        np.asarray(embedding, np.float32).tobytes(),
+                        created_at,
+                        created_at,
+                    ),
+                )
+            self.db_writes += 1
+            if self.db_writes % EMBEDDING_CACHE_DB_SWEEP_EVERY == 0:
+                self.sweep_db()
+
+    def sweep_db(self):
+        """
+        Delete expired rows, and the least recently used ones beyond
+        db_max_size, like the memory LRU
+        """
+        with self.db:
+            self.db.execute(
+                "DELETE FROM query_embeddings WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+            self.db.execute(
+                "DELETE FROM query_embeddings WHERE key IN (SELECT key FROM "
+                "query_embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.db_max_size,),
+            )
+
+    def set_memory(self, key, embedding, created_at):
+        # plain lists whatever the backend returned (the local one: numpy arrays)
+        self.entries[key] = (np.asarray(embedding, np.float32).tolist(), created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+query_embedding_cache = EmbeddingCache(
+    EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_DB
+)
+
+
+async def get_document_embeddings(texts):
+    if EMBEDDINGS_BACKEND == "local":
+        return await local_embeddings.get_embeddings(texts)
+    return await get_embeddings(texts)
+
+
+def get_embeddings_sync(texts):
+    if EMBEDDINGS_BACKEND == "local":
+        return list(local_embeddings.get_embeddings_sync(texts))
+    return [get_embedding(text) for text in texts]
+
+
+async def get_query_embedding(text, model=EMBEDDINGS_MODEL):
+    embedding = query_embedding_cache.get(text, model)
+    if embedding is None:
+        if EMBEDDINGS_BACKEND == "local":
+            embedding = (await local_embeddings.get_embeddings([text], model))[0]
+            embedding = embedding.tolist()
+        else:
+            embedding = await get_embedding_async(text, model)
+        query_embedding_cache.set(text, model, embedding)
+    return embedding
+
+
+def warm_up():
+    if EMBEDDINGS_BACKEND == "local":
+        local_embeddings.warm_up()
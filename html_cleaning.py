@@ -0,0 +1,170 @@
+"""
+HTML normalization shared by the webhook (conversation parts) and the indexer
+(article sections). Fragments are parsed with lxml, which does the work in C
+instead of building a BeautifulSoup tree in Python. Conversation parts never
+change once posted, so cleaned parts are memoized by part id.
+
+The output is serialized the way BeautifulSoup did (sorted attributes, empty
+attributes written as ="", <br/>), so checksums of existing sections stay the
+same. The exception is invalid nesting (e.g. a <div> in a <p>, unclosed <li>),
+which lxml repairs like a browser does: those sections get a new checksum and
+are embedded again on the next reindex.
+"""
+import html
+import os
+import re
+from collections import OrderedDict
+import lxml.html
+from lxml import etree
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PART_CACHE_SIZE = int(os.getenv("PART_CACHE_SIZE", 5000))
+
+INLINE_ELEMENTS = ["a", "em", "strong", "span", "b", "i", "code"]
+# lxml writes <br>, BeautifulSoup wrote <br/>. Keep the old form so section
+# checksums (and with them the stored embeddings) stay valid.
+VOID_TAG_RE = re.compile(
+    r"<((?:area|base|br|col|embed|hr|img|input|link|meta|param|source|track|wbr)\b[^>]*?)/?>"
+)
+# lxml writes these bare (dropping their value), so they're renamed while
+# serializing. BeautifulSoup kept them like any other attribute, e.g. checked="".
+BOOLEAN_ATTRIBUTES = {
+    "checked",
+    "compact",
+    "declare",
+    "defer",
+    "disabled",
+    "ismap",
+    "multiple",
+    "nohref",
+    "noresize",
+    "noshade",
+    "nowrap",
+    "readonly",
+    "selected",
+}
+BOOLEAN_ATTRIBUTE_PREFIX = "data-lxml-boolean-"
+
+
+def parse_fragment(content):
+    """
+    Parse an HTML fragment into a <div> holding it
+    (the div keeps lxml from wrapping loose text in a <p> of its own)
+    """
+    div = lxml.html.fragment_fromstring(content, create_parent="div")
+    for element in div.iter(etree.Element):
+        attributes = element.attrib.items()
+        if attributes and (
+            attributes != sorted(attributes)
+            or any(name in BOOLEAN_ATTRIBUTES or not value for name, value in attributes)
+        ):
+            # setting them again also gives attributes without a value ="",
+            # rather than leaving them bare
+            element.attrib.clear()
+            for name, value in sorted(attributes):
+                if name in BOOLEAN_ATTRIBUTES:
+                    # lxml reads a bare checked as checked="checked"
+                    value = "" if value == name else value
+                    name = BOOLEAN_ATTRIBUTE_PREFIX + name
+                element.set(name, value)
+    return div
+
+
+def to_html(element):
+    content = lxml.html.tostring(element, encoding="unicode")
+    if BOOLEAN_ATTRIBUTE_PREFIX in content:
+        content = content.replace(BOOLEAN_ATTRIBUTE_PREFIX, "")
+    return VOID_TAG_RE.sub(r"<\1/>", content)
+
+
+def inner_html(div):
+    return html.escape(div.text or "", quote=False) + "".join(
+        to_html(child) for child in div
+    )
+
+
+def strip_patterns(*texts):
+    """
+    One regex removing any of the texts, longest first so e.g. a full notice
+    is removed in one piece rather than part by part
+    """
+    texts = sorted(texts, key=len, reverse=True)
+    return re.compile("|".join(re.escape(text) for text in texts))
+
+
+def wrap_paragraphs(content):
+    """
+    Wrap loose text and inline elements in <p> tags, so every reply is made of
+    block elements
+    """
+    if not content.strip():
+        return content
+    div = parse_fragment(content)
+    # (is it loose text or inline?, html) for each top level node in order
+    nodes = []
+    if div.text:
+        nodes.append((bool(div.text.strip()), html.escape(div.text, quote=False)))
+    for child in div:
+        tail = child.tail
+        child.tail = None
+        # (BeautifulSoup saw comments as strings, so they stay in the paragraph)
+        is_inline = child.tag in INLINE_ELEMENTS or (
+            child.tag is etree.Comment and bool(child.text.strip())
+        )
+        nodes.append((is_inline, to_html(child)))
+        if tail:
+            nodes.append((bool(tail.strip()), html.escape(tail, quote=False)))
+
+    cleaned_html = ""
+    paragraph = None
+    for is_inline, node_html in nodes:
+        if is_inline:
+            paragraph = (paragraph or "") + node_html
+            continue
+        if paragraph is not None:
+            cleaned_html += f"<p>{paragraph}</p>"
+            paragraph = None
+        cleaned_html += node_html
+    if paragraph is not None:
+        cleaned_html += f"<p>{paragraph}</p>"
+    return cleaned_html
+
+
+def clean_section(content):
+    """
+    Remove class and id attributes and empty paragraphs, and minify
+    """
+    if not content.strip():
+        return ""
+    div = parse_fragment(content)
+    for element in div.iter():
+        element.attrib.pop("class", None)
+        element.attrib.pop("id", None)
+    for p in div.findall(".//p"):
+        if not p.text_content().strip():
+            # keeps the text following the paragraph
+            p.drop_tree()
+    return "".join(line.strip() for line in inner_html(div).split("\n"))
+
+
+# conversation part id -> cleaned body
+part_cache = OrderedDict()
+
+
+def clean_part(part, strip=None):
+    """
+    Clean a conversation part's body, removing matches of the strip regex first
+    (e.g. the experimental notice appended to our replies)
+    """
+    cleaned_body = part_cache.get(part["id"])
+    if cleaned_body is not None:
+        part_cache.move_to_end(part["id"])
+        return cleaned_body
+    body = strip.sub("", part["body"]) if strip else part["body"]
+    cleaned_body = wrap_paragraphs(body)
+    part_cache[part["id"]] = cleaned_body
+    if len(part_cache) > PART_CACHE_SIZE:
+        part_cache.popitem(last=False)
+    return cleaned_body
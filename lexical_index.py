@@ -0,0 +1,189 @@
+"""
+In-memory BM25 index over the (HTML stripped) section content. Catches exact
+product terms, error codes and feature names that embeddings rank poorly, and
+still works when the embeddings API is slow or down.
+"""
+import html
+import json
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+import numpy as np
+
+# Get the absolute path of the current script
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# stored next to the vector index, for Chroma (the NumPy index keeps it in its
+# snapshots)
+index_path = os.path.join(script_dir, ".vectors", "bm25.json")
+
+TAG_RE = re.compile(r"<[^>]+>")
+TOKEN_RE = re.compile(r"\w+")
+BM25_ARRAYS_RE = re.compile(r"bm25-(\d+)\.npy$")
+
+
+def strip_html(content):
+    return html.unescape(TAG_RE.sub(" ", content))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Postings are stored as flat arrays (document positions and term
+    frequencies, each term a slice of them), memory-mapped when loaded, so
+    processes reading the index share them
+    """
+
+    def __init__(
+        self, ids, doc_lengths, vocabulary, positions, frequencies, k1=1.5, b=0.75
+    ):
+        self.ids = ids
+        self.doc_lengths = doc_lengths
+        # term -> [start, end] of its slice of positions and frequencies
+        self.vocabulary = vocabulary
+        self.positions = positions
+        self.frequencies = frequencies
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0
+
+    @classmethod
+    def build(cls, documents):
+        """
+        documents: iterable of (id, html content)
+        """
+        ids = []
+        doc_lengths = []
+        postings = defaultdict(list)
+        for position, (id, content) in enumerate(documents):
+            tokens = tokenize(strip_html(content))
+            ids.append(id)
+            doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings[term].append((position, frequency))
+
+        vocabulary = {}
+        positions = []
+        frequencies = []
+        for term, term_postings in postings.items():
+            vocabulary[term] = [len(positions), len(positions) + len(term_postings)]
+            for position, frequency in term_postings:
+                positions.append(position)
+                frequencies.append(frequency)
+        return cls(
+            ids,
+            np.array(doc_lengths, dtype=np.int32),
+            vocabulary,
+            np.array(positions, dtype=np.int32),
+            np.array(frequencies, dtype=np.int32),
+        )
+
+    @classmethod
+    def load(cls, path=index_path):
+        with open(path) as f:
+            index = json.load(f)
+        arrays = np.load(
+            os.path.join(os.path.dirname(path), index["arrays_file"]), mmap_mode="r"
+        )
+        n_docs = len(index["ids"])
+        n_postings = index["n_postings"]
+        return cls(
+            index["ids"],
+            arrays[:n_docs],
+            index["vocabulary"],
+            arrays[n_docs : n_docs + n_postings],
+            arrays[n_docs + n_postings :],
+        )
+
+    def save(self, path=index_path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # a new arrays file each time, processes may still be reading the old one
+        arrays_file = f"bm25-{time.time_ns()}.npy"
+        np.save(
+            os.path.join(directory, arrays_file),
+            np.concatenate([self.doc_lengths, self.positions, self.frequencies]),
+        )
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "ids": self.ids,
+                    "vocabulary": self.vocabulary,
+                    "n_postings": len(self.positions),
+                    "arrays_file": arrays_file,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+        # keep the previous arrays for readers still loading that version
+        arrays_files = sorted(
+            (name for name in os.listdir(directory) if BM25_ARRAYS_RE.match(name)),
+            key=lambda name: int(BM25_ARRAYS_RE.match(name)[1]),
+        )
+        for name in arrays_files[:-2]:
+            os.remove(os.path.join(directory, name))
+
+    def search(self, query, n_results=10):
+        """
+        returns a list of (id, score), best match first
+        """
+        n_docs = len(self.ids)
+        scores = np.zeros(n_docs, dtype=np.float64)
+        for term in set(tokenize(query)):
+            if term not in self.vocabulary:
+                continue
+            start, end = self.vocabulary[term]
+            positions = self.positions[start:end]
+            frequencies = self.frequencies[start:end]
+            idf = math.log(1 + (n_docs - len(positions) + 0.5) / (len(positions) + 0.5))
+            length_norm = (
+                1
+                - self.b
+                + self.b * (self.doc_lengths[positions] / self.avg_doc_length)
+            )
+            # a term occurs once per document, so positions are unique
+            scores[positions] += (
+                idf
+                * frequencies
+                * (self.k1 + 1)
+                / (frequencies + self.k1 * length_norm)
+            )
+        matches = np.flatnonzero(scores)
+        ranked = matches[np.argsort(-scores[matches], kind="stable")][:n_results]
+        return [(self.ids[position], float(scores[position])) for position in ranked]
+
+
+_index = None
+_index_mtime = None
+
+
+def get_lexical_index():
+    """
+    The index of the current vector index snapshot, or the saved one (Chroma,
+    or snapshots from before they had one), reloaded whenever make_embeddings
+    rebuilds it
+    """
+    global _index, _index_mtime
+    # (the vector store imports this module)
+    from api.vector_store import VECTOR_STORE, collection
+
+    if VECTOR_STORE != "chroma" and collection.lexical_index is not None:
+        return collection.lexical_index
+    try:
+        mtime = os.path.getmtime(index_path)
+    except FileNotFoundError:
+        return None
+    if mtime != _index_mtime:
+        try:
+            _index = BM25Index.load()
+        except KeyError:
+            # saved in an older format, rebuilt on the next reindex
+            _index = None
+        _index_mtime = mtime
+    return _index
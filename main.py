@@ -3,16 +3,27 @@ import hashlib
 import hmac
 import os
 import subprocess
-from bs4 import BeautifulSoup, NavigableString
+import sys
+import time
 from quart import Quart, request, jsonify
 from dotenv import load_dotenv
 from termcolor import cprint
-from api.intercom import close_conversation, get_conversation, send_reply
-from clean_chroma_sections import clean_chroma_sections
+from api.intercom import (
+    close_conversation,
+    close_session,
+    get_conversation,
+    send_reply,
+)
+from conversation_cache import conversation_cache
+from embeddings import warm_up
 from functions import execute_function_call
-from make_embeddings import make_embeddings
+from html_cleaning import clean_part, strip_patterns, wrap_paragraphs
+from api.vector_store import VECTOR_STORE, collection
+from make_embeddings import REINDEX_LOCKED_EXIT_CODE, reindex_lock
+import metrics
+from work_queue import WORK_QUEUE_WORKERS, work_queue
 
-from reply import get_answer
+from reply import SKIP_SINGLE_MESSAGE_SUMMARY, get_answer, refresh_index
 
 load_dotenv()
 
@@ -29,14 +40,92 @@ AUTHOR_LABELS = {
 EXPERIMENTAL_NOTICE_INNER = f"NOTE: {REPLY_ADMIN_NAME} is our experimental AI chatbot. It may not always provide a correct answer. A human will follow up if needed."
 DIVIDER = "<p>_____</p>"
 EXPERIMENTAL_NOTICE = f"{DIVIDER}<p><i>{EXPERIMENTAL_NOTICE_INNER}</i></p>"
+# strips the notice from our past replies, also just the DIVIDER or
+# EXPERIMENTAL_NOTICE_INNER (intercom sometimes modifies the HTML)
+EXPERIMENTAL_NOTICE_RE = strip_patterns(
+    EXPERIMENTAL_NOTICE, DIVIDER, EXPERIMENTAL_NOTICE_INNER
+)
 TEST_MODE = os.getenv("TEST_MODE", "false").lower() == "true"
 GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
 UPDATE_ARTICLES_SECRET = os.getenv("UPDATE_ARTICLES_SECRET")
-
+# required to read /metrics, which is off without it
+METRICS_SECRET = os.getenv("METRICS_SECRET")
+# wait this long for follow-up messages before answering, so they get one reply
+# (a newer webhook replaces the queued one)
+WEBHOOK_COALESCE_SECONDS = float(os.getenv("WEBHOOK_COALESCE_SECONDS", 2))
+# set to false when a separate indexer (python reindex.py) keeps the index up to date
+REINDEX_ON_STARTUP = os.getenv("REINDEX_ON_STARTUP", "true").lower() == "true"
+
+
+# this worker's last reindex, reported on /healthz
+reindex_status = {
+    "running": False,
+    "started_at": None,
+    "finished_at": None,
+    "exit_code": None,
+}
 
 app = Quart(__name__)
 
 
+@app.before_serving
+async def warm_up_embeddings():
+    # load the local embeddings model (if used) before the first question
+    await asyncio.to_thread(warm_up)
+
+
+@app.before_serving
+async def start_reindex():
+    # serve from the current index right away, update it in the background
+    if REINDEX_ON_STARTUP:
+        app.add_background_task(reindex)
+
+
+async def reindex():
+    """
+    Run reindex.py in a separate process, so it doesn't slow down replies. Only
+    one of the server workers does, the others pick up the new index when it's
+    ready (see NumpyCollection.refresh).
+    """
+    with reindex_lock() as lock_file:
+        if lock_file is None:
+            cprint("Another process is reindexing", "yellow")
+            return
+        reindex_status.update(running=True, started_at=time.time())
+        # the lock is held until the reindex is done, also if this worker exits
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "reindex.py",
+            "--lock-fd",
+            str(lock_file.fileno()),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            pass_fds=[lock_file.fileno()],
+        )
+        exit_code = await process.wait()
+    reindex_status.update(running=False, finished_at=time.time(), exit_code=exit_code)
+    if exit_code == REINDEX_LOCKED_EXIT_CODE:
+        cprint("Another process is reindexing", "yellow")
+    elif exit_code:
+        cprint(f"Reindex failed with exit code {exit_code}", "red")
+    else:
+        refresh_index()
+
+
+@app.before_serving
+async def start_work_queue():
+    await work_queue.start(process_webhook, WORK_QUEUE_WORKERS)
+
+
+@app.after_serving
+async def stop_work_queue():
+    await work_queue.stop()
+
+
+@app.after_serving
+async def close_http_session():
+    await close_session()
+
+
 @app.route("/")
 async def hello_world():
     # if update articles secret in GET request is correct, update embeddings
@@ -47,18 +136,84 @@ async def hello_world():
     return "Beep boop! We're live!"
 
 
+@app.route("/healthz")
+async def healthz():
+    """
+    Ready once there is an index to answer from
+    """
+    refresh_index()
+    index = {
+        "backend": VECTOR_STORE,
+        "version": getattr(collection, "version", None),
+        "sections": collection.count(),
+        "embeddings_model": (collection.metadata or {}).get("embeddings_model"),
+    }
+    ready = index["sections"] > 0
+    return (
+        jsonify(ready=ready, index=index, reindex=reindex_status),
+        200 if ready else 503,
+    )
+
+
+@app.route("/metrics")
+async def get_metrics():
+    # internal counters: only with the secret, in a header or the query string
+    secret = request.headers.get("X-Metrics-Secret") or request.args.get("secret", "")
+    if not METRICS_SECRET or not hmac.compare_digest(
+        secret.encode("utf-8"), METRICS_SECRET.encode("utf-8")
+    ):
+        return jsonify(success=False, message="Invalid secret"), 403
+    return jsonify(metrics.get_metrics())
+
+
 @app.route("/webhook", methods=["POST"])
 async def intercom_webhook():
     # Validate if the incoming request is from Intercom
     if not await validate_intercom_request(request):
         return jsonify(success=False, message="Invalid request"), 400
 
-    # Process the webhook data asynchronously
+    # Queue the webhook, workers process it asynchronously
     webhook_data = await request.json
-    result = app.add_background_task(process_webhook, webhook_data)
+    item = webhook_data["data"]["item"]
+    metrics.increment("webhooks_received")
+    # record the new parts now, even if this webhook ends up coalesced
+    cache_conversation_parts(item)
+    # wait a little for follow-up messages, so they get a single reply
+    replaced = await work_queue.enqueue(
+        item["id"], webhook_data, delay=WEBHOOK_COALESCE_SECONDS
+    )
+    if replaced is not None:
+        metrics.increment("webhooks_coalesced")
+        metrics.increment(
+            "completions_saved", get_reply_completions(replaced["data"]["item"])
+        )
     return "OK"
 
 
+def is_assigned_elsewhere(item):
+    return bool(
+        (item["admin_assignee_id"] and item["admin_assignee_id"] != REPLY_ADMIN_ID)
+        or item["team_assignee_id"]
+    )
+
+
+def get_reply_completions(item):
+    """
+    Chat completions replying to the conversation of a webhook item takes (not
+    counting a second answer after a function call): the question summary,
+    unless it's a single message, and the answer
+    """
+    if item["type"] != "conversation":
+        return 0
+    if is_assigned_elsewhere(item) and not TEST_MODE:
+        return 0
+    single_message = (
+        item["conversation_parts"]["total_count"] == 0
+        and get_author_role(item["source"]["author"]) == "user"
+    )
+    return 1 if SKIP_SINGLE_MESSAGE_SUMMARY and single_message else 2
+
+
 async def process_webhook(webhook_data):
     print(f"Received webhook: {webhook_data}")
 
@@ -67,9 +222,7 @@ async def process_webhook(webhook_data):
     if not item["type"] == "conversation":
         return
     # only reply to conversations that are unassigned or assigned to the bot
-    if (
-        item["admin_assignee_id"] and item["admin_assignee_id"] != REPLY_ADMIN_ID
-    ) or item["team_assignee_id"]:
+    if is_assigned_elsewhere(item):
         if TEST_MODE:
             # in test mode, we want to process all conversations
             cprint(
@@ -80,17 +233,41 @@ async def process_webhook(webhook_data):
 
     messages = await prep_conversation(item)
 
-    response_message, messages = await get_answer(messages)
+    function_call_task = None
 
-    if await conversation_updated(item):
-        return
+    async def hand_off(name):
+        await work_queue.release()
+        return await execute_function_call(
+            {"function_call": {"name": name}}, item["id"]
+        )
+
+    def start_function_call(name):
+        # e.g. hand off to a human while the rest of the reply is still streaming
+        nonlocal function_call_task
+        if function_call_task is None:
+            function_call_task = asyncio.create_task(hand_off(name))
+
+    try:
+        response_message, messages = await get_answer(
+            messages, on_function_call=start_function_call
+        )
+        # from here on we act on the conversation, don't get superseded half way
+        await work_queue.release()
+    except BaseException:
+        if function_call_task is not None:
+            # a hand-off that got to act finishes, a superseded one stops itself
+            await asyncio.gather(function_call_task, return_exceptions=True)
+        raise
 
     if response_message.get("function_call"):
         if response_message["content"]:
             # if there's a function call and content, send the content first
             await send_response(item, response_message["content"])
-        # execute function call
-        results = await execute_function_call(response_message, item["id"])
+        # execute function call, unless it already started while streaming
+        if function_call_task is None:
+            results = await execute_function_call(response_message, item["id"])
+        else:
+            results = await function_call_task
         messages.append(
             {
                 "role": "function",
@@ -105,32 +282,6 @@ async def process_webhook(webhook_data):
     return result
 
 
-async def conversation_updated(item):
-    """
-    Check if conversation has been updated since webhook was sent
-    """
-    # fetch conversation again from api to make sure it hasn't been updated
-    conversation = await get_conversation(item["id"])
-    # check conversation parts to see if a new reply has been added (ignoring bot replies)
-    fetched_non_bot_conversation_parts = [
-        cp
-        for cp in conversation["conversation_parts"]["conversation_parts"]
-        if cp["author"]["type"] != "bot"
-    ]
-    # if webhook item has no conversation parts, any non-bot message will be newer
-    # otherwise, we check if the last message is the same (id) as the last non-bot message
-    webhook_item_conversation_parts = item["conversation_parts"]["conversation_parts"]
-    if fetched_non_bot_conversation_parts and (
-        not webhook_item_conversation_parts
-        or fetched_non_bot_conversation_parts[-1]["id"]
-        != webhook_item_conversation_parts[-1]["id"]
-    ):
-        # there's already a newer reply, don't reply
-        cprint("Conversation already updated", "red")
-        return True
-    return False
-
-
 async def send_response(conversation, response_message):
     conversation_id = conversation["id"]
     if "SKIP" in response_message:
@@ -139,7 +290,7 @@ async def send_response(conversation, response_message):
         # strip out CLOSE and send the rest of the message
         response_message = response_message.replace("CLOSE", "").strip()
         if response_message:
-            response_message = clean_html(response_message)
+            response_message = wrap_paragraphs(response_message)
             result = await send_reply(
                 conversation_id, response_message + EXPERIMENTAL_NOTICE
             )
@@ -148,38 +299,31 @@ async def send_response(conversation, response_message):
         else:
             result = await close_conversation(conversation_id)
     else:
-        response_message = clean_html(response_message)
+        response_message = wrap_paragraphs(response_message)
         if not response_message:
             # if message is empty, don't send it
             return
         result = await send_reply(
             conversation_id, response_message + EXPERIMENTAL_NOTICE
         )
+    # the response is the conversation, including our reply
+    cache_conversation_parts(result)
     return result
 
 
-def clean_html(html):
-    soup = BeautifulSoup(html, "html.parser")
-    block_elements = ["p", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote"]
-    inline_elements = ["a", "em", "strong", "span", "b", "i", "code"]
-
-    def wrap_text_and_inline_in_p(tag):
-        current_paragraph = None
-        for content in list(tag.contents):
-            if (isinstance(content, NavigableString) and content.string.strip()) or (
-                content.name in inline_elements
-            ):
-                if current_paragraph is None:
-                    current_paragraph = soup.new_tag("p")
-                    content.insert_before(current_paragraph)
-                current_paragraph.append(content)
-            else:
-                current_paragraph = None
-
-    wrap_text_and_inline_in_p(soup)
-
-    cleaned_html = str(soup)
-    return cleaned_html
+def cache_conversation_parts(conversation):
+    """
+    Add the conversation parts of a webhook item or API response to the cache
+    """
+    if not conversation or conversation.get("type") != "conversation":
+        return
+    conversation_parts = conversation.get("conversation_parts")
+    if conversation_parts is not None:
+        conversation_cache.update(
+            conversation["id"],
+            conversation_parts["conversation_parts"],
+            conversation_parts["total_count"],
+        )
 
 
 def get_author_role(author):
@@ -201,11 +345,22 @@ async def prep_conversation(item):
     body = item["source"]["body"]
     messages = [{"role": author_role, "content": f"{author_label}{body}"}]
 
-    if item["conversation_parts"]["total_count"] > 0:
-        # make API request to fetch full conversation
-        conversation = await get_conversation(item["id"])
-        # add conversation_parts to messages
-        convo_parts = conversation["conversation_parts"]["conversation_parts"]
+    total_count = item["conversation_parts"]["total_count"]
+    if total_count > 0:
+        # this process may not have seen the webhook, add its parts first
+        cache_conversation_parts(item)
+        latest_parts = item["conversation_parts"]["conversation_parts"]
+        convo_parts = conversation_cache.get(
+            item["id"],
+            total_count=total_count,
+            last_part_id=latest_parts[-1]["id"] if latest_parts else None,
+        )
+        if convo_parts is None:
+            # make API request to fetch full conversation
+            conversation = await get_conversation(item["id"])
+            metrics.increment("conversation_fetches")
+            convo_parts = conversation["conversation_parts"]["conversation_parts"]
+            conversation_cache.store(item["id"], convo_parts)
         # include only parts with body
         convo_parts = [part for part in convo_parts if part["body"]]
 
@@ -223,12 +378,7 @@ async def prep_conversation(item):
             # skip if note and from REPLY_ADMIN_ID
             if part["part_type"] == "note" and part["author"]["id"] == REPLY_ADMIN_ID:
                 continue
-            # strip EXPERIMENTAL_NOTICE
-            body = part["body"].replace(EXPERIMENTAL_NOTICE, "")
-            # strip DIVIDER and EXPERIMENTAL_NOTICE_INNER (intercom sometimes modifies the HTML)
-            body = body.replace(DIVIDER, "")
-            body = body.replace(EXPERIMENTAL_NOTICE_INNER, "")
-            body = clean_html(body)
+            body = clean_part(part, strip=EXPERIMENTAL_NOTICE_RE)
 
             author_role = get_author_role(part["author"])
             author_label = get_author_label(part["author"])
@@ -283,9 +433,5 @@ async def deploy():
         return "Method Not Allowed", 405
 
 
-# update embeddings on startup
-asyncio.run(make_embeddings())
-clean_chroma_sections()
-
 if __name__ == "__main__":
     app.run(port=5000)
@@ -1,24 +1,48 @@
 import argparse
-import ast
 import asyncio
+import fcntl
 from contextlib import contextmanager
 import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import time
 from typing import Any, Dict, List
-from bs4 import BeautifulSoup
+import numpy as np
 
 from sqlalchemy import (
     Column,
     ForeignKey,
     Integer,
+    LargeBinary,
     String,
     Text,
     create_engine,
+    inspect,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
 from termcolor import cprint
 
-from api.chroma import collection
-from api.openai import get_embedding
+from api.vector_store import (
+    VECTOR_STORE,
+    collection,
+    deferred_persist,
+    persist_directory,
+)
+from api.openai import OPENAI_EMBEDDINGS_BATCH_SIZE
+from embeddings import EMBEDDINGS_MODEL, get_document_embeddings
+from html_cleaning import clean_section
+from lexical_index import BM25Index
+
+WORKERS = int(os.getenv("EMBEDDINGS_WORKERS", 4))
+# "float32" or "float16" (half the size, plenty of precision for search)
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")
+# bound parameters per statement: SQLite's limit before 3.32 (32766 since)
+SQLITE_MAX_VARIABLES = 999
+REINDEX_LOCK_PATH = os.path.join(persist_directory, "reindex.lock")
+# exit code when another process is reindexing already (EX_TEMPFAIL)
+REINDEX_LOCKED_EXIT_CODE = 75
 
 Base = declarative_base()
 
@@ -41,10 +65,41 @@ class Section(Base):
     __tablename__ = "sections"
 
     id = Column(Integer, primary_key=True)
-    article_id = Column(Integer, ForeignKey("articles.id"))
-    checksum = Column(String)
+    article_id = Column(Integer, ForeignKey("articles.id"), index=True)
+    checksum = Column(String, index=True)
     content = Column(Text)
-    embedding = Column(Text)
+    # packed array of EMBEDDING_DTYPE values, see encode_embedding
+    embedding = Column(LargeBinary)
+    embedding_dtype = Column(String)
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+
+    key = Column(String, primary_key=True)
+    value = Column(Integer)
+
+
+def encode_embedding(embedding, dtype=EMBEDDING_DTYPE):
+    return np.asarray(embedding, dtype=dtype).tobytes()
+
+
+def decode_embedding(blob, dtype=EMBEDDING_DTYPE):
+    # zero-copy view on the blob (read-only)
+    return np.frombuffer(blob, dtype=dtype or "float32")
+
+
+def create_tables():
+    Base.metadata.create_all(engine)
+    columns = [c["name"] for c in inspect(engine).get_columns(Section.__tablename__)]
+    if "embedding_dtype" not in columns:
+        # db from before embeddings were stored as binary
+        from migrate_embeddings import migrate_embeddings
+
+        migrate_embeddings()
+    # create_all skips indexes of tables that already exist
+    for index in Section.__table__.indexes:
+        index.create(engine, checkfirst=True)
 
 
 @contextmanager
@@ -60,49 +115,115 @@ def session_scope():
         session.close()
 
 
-def store_articles(articles: List[Dict[str, Any]], force_update_ids: List[int] = []):
-    updated_articles = []
+def get_sync_state(key):
+    with session_scope() as db_session:
+        sync_state = db_session.get(SyncState, key)
+        return sync_state.value if sync_state else None
+
 
+def set_sync_state(key, value):
     with session_scope() as db_session:
-        Base.metadata.create_all(engine)
-        for article in articles:
-            if not article["body"] or article["state"] != "published":
-                continue
+        db_session.merge(SyncState(key=key, value=value))
 
-            existing_article = (
-                db_session.query(Article).filter(Article.id == article["id"]).first()
-            )
 
-            if not existing_article:
-                new_article = Article(
-                    id=article["id"],
-                    title=article["title"],
-                    description=article["description"],
-                    body=article["body"],
-                    url=article["url"],
-                    updated_at=article["updated_at"],
-                )
-                db_session.add(new_article)
-                updated_articles.append(article)
+def select_updated_articles(articles, stored_updated_at, force_update_ids=[]):
+    """
+    New and changed articles (published, with a body), given the stored
+    articles' id -> updated_at
+    """
+    force_update_ids = set(force_update_ids)
+    return [
+        article
+        for article in articles
+        if article["body"]
+        and article["state"] == "published"
+        and (
+            int(article["id"]) not in stored_updated_at
+            or stored_updated_at[int(article["id"])] < article["updated_at"]
+            or int(article["id"]) in force_update_ids
+        )
+    ]
+
+
+def get_updated_articles(articles, force_update_ids=[]):
+    """
+    The articles store_articles would store, without storing them
+    """
+    with session_scope() as db_session:
+        create_tables()
+        stored_updated_at = dict(db_session.query(Article.id, Article.updated_at))
+    return select_updated_articles(articles, stored_updated_at, force_update_ids)
 
-            elif (
-                existing_article.updated_at < article["updated_at"]
-                or int(article["id"]) in force_update_ids
-            ):
-                existing_article.title = article["title"]
-                existing_article.description = article["description"]
-                existing_article.body = article["body"]
-                existing_article.url = article["url"]
-                existing_article.updated_at = article["updated_at"]
-                updated_articles.append(article)
+
+def store_articles(
+    articles: List[Dict[str, Any]],
+    force_update_ids: List[int] = [],
+    article_ids: List[int] = None,
+):
+    """
+    Store new and updated articles, delete the ones not in article_ids
+    (defaults to the ids of the given articles) and their sections
+    """
+    start = time.perf_counter()
+
+    with session_scope() as db_session:
+        create_tables()
+        # id -> updated_at of all stored articles, in one query
+        stored_updated_at = dict(db_session.query(Article.id, Article.updated_at))
+        loaded_at = time.perf_counter()
+        updated_articles = select_updated_articles(
+            articles, stored_updated_at, force_update_ids
+        )
+        diffed_at = time.perf_counter()
+
+        # insert new and update changed articles in bulk, as many rows per
+        # statement as the bound parameter limit allows
+        columns = ["id", "title", "description", "body", "url", "updated_at"]
+        batch_size = SQLITE_MAX_VARIABLES // len(columns)
+        rows = [
+            {
+                "id": int(article["id"]),
+                "title": article["title"],
+                "description": article["description"],
+                "body": article["body"],
+                "url": article["url"],
+                "updated_at": article["updated_at"],
+            }
+            for article in updated_articles
+        ]
+        for i in range(0, len(rows), batch_size):
+            statement = sqlite_insert(Article).values(rows[i : i + batch_size])
+            statement = statement.on_conflict_do_update(
+                index_elements=[Article.id],
+                set_={column: statement.excluded[column] for column in columns[1:]},
+            )
+            db_session.execute(statement)
+        upserted_at = time.perf_counter()
 
         # Delete articles that no longer exist
-        fetched_article_ids = [int(a["id"]) for a in articles]
-        for existing_article in db_session.query(Article).all():
-            if existing_article.id not in fetched_article_ids:
-                cprint(f"Deleting article: {existing_article.title}", "red")
-                db_session.delete(existing_article)
+        fetched_article_ids = set(
+            article_ids if article_ids is not None else [int(a["id"]) for a in articles]
+        )
+        removed_ids = stored_updated_at.keys() - fetched_article_ids
+        if removed_ids:
+            cprint(f"Deleting articles: {sorted(removed_ids)}", "red")
+            removed = sorted(removed_ids)
+            for i in range(0, len(removed), SQLITE_MAX_VARIABLES):
+                batch = removed[i : i + SQLITE_MAX_VARIABLES]
+                db_session.query(Section).filter(Section.article_id.in_(batch)).delete(
+                    synchronize_session=False
+                )
+                db_session.query(Article).filter(Article.id.in_(batch)).delete(
+                    synchronize_session=False
+                )
+        deleted_at = time.perf_counter()
 
+    cprint(
+        f"store_articles: load {loaded_at - start:.3f}s, diff {diffed_at - loaded_at:.3f}s, "
+        f"upsert {upserted_at - diffed_at:.3f}s ({len(rows)}), "
+        f"delete {deleted_at - upserted_at:.3f}s ({len(removed_ids)})",
+        "blue",
+    )
     return updated_articles
 
 
@@ -151,33 +272,12 @@ def clean_sections(sections):
     """
     cleaned_sections = []
     for section in sections:
-        cs = clean_html(section)
+        cs = clean_section(section)
         if cs:
             cleaned_sections.append(cs)
     return cleaned_sections
 
 
-def clean_html(html):
-    soup = BeautifulSoup(html, "html.parser")
-
-    # Remove class and id attributes
-    for tag in soup():
-        if "class" in tag.attrs:
-            del tag.attrs["class"]
-        if "id" in tag.attrs:
-            del tag.attrs["id"]
-
-    # Remove empty paragraphs
-    for p in soup.find_all("p"):
-        if not p.get_text(strip=True):
-            p.decompose()
-
-    # Minify: remove all whitespace
-    minified_html = "".join(line.strip() for line in str(soup).split("\n"))
-
-    return minified_html
-
-
 def get_annotation(article: dict):
     title = article["title"]
     description = article["description"]
@@ -204,76 +304,124 @@ def generate_checksum(section):
     return hashlib.md5(section.encode("utf-8")).hexdigest()
 
 
-def store_sections(sections: List[str], article: dict):
-    sections = annotate_sections(clean_sections(sections), article)
+def prepare_article(article: dict):
+    """
+    Split, clean and annotate an article's sections (runs in a worker process)
+    returns the article and a dict of checksum -> section
+    """
+    sections = annotate_sections(clean_sections(make_sections(article)), article)
+    return article, {generate_checksum(section): section for section in sections}
+
+
+def diff_sections(article: dict, sections: Dict[str, str]):
+    """
+    Compare an article's sections with the stored ones
+    returns a plan of the sections to embed, re-add and remove
+    """
     article_id = article["id"]
-    url = article["url"]
+    plan = {
+        "article_id": article_id,
+        "metadata": {"article_id": article_id, "source": article["url"]},
+        # new sections, or stored ones without an embedding: checksum -> section
+        "embed": {},
+        # stored sections missing from the vector store: checksum -> embedding
+        "readd": {},
+        "removed": [],
+        "embeddings": {},
+        "sections": sections,
+    }
     with session_scope() as db_session:
-        # Get existing sections for the article
-        existing_sections = (
-            db_session.query(Section).filter(Section.article_id == article_id).all()
+        # checksums of the article's sections in the db and in the vector store
+        stored_checksums = {
+            checksum
+            for (checksum,) in db_session.query(Section.checksum).filter(
+                Section.article_id == article_id
+            )
+        }
+        indexed_checksums = set(
+            collection.get(where={"article_id": article_id}, include=[])["ids"]
         )
 
-        # Initialize helper variables
-        matched_existing_sections = []
-        removed_sections = []
-        embeddings = []
-        documents = []
-        metadatas = []
-        ids = []
-
-        # Step through the sections
-        for section in sections:
-            # Generate the checksum for the section
-            checksum = generate_checksum(section)
-
-            # If a section with the same checksum already exists, skip it
-            if any([checksum == s.checksum for s in existing_sections]):
-                matched_existing_sections.append(checksum)
-                # make sure it also exists in chroma
-                if not collection.get(checksum)["ids"]:
-                    # retrieve existing section from db and add to chroma
-                    existing_section = (
-                        db_session.query(Section).filter_by(checksum=checksum).first()
-                    )
+        # stored sections missing from the vector store: re-add their embeddings
+        missing_checksums = (stored_checksums & sections.keys()) - indexed_checksums
+        if missing_checksums:
+            for checksum, embedding, dtype in db_session.query(
+                Section.checksum, Section.embedding, Section.embedding_dtype
+            ).filter(
+                Section.article_id == article_id,
+                Section.checksum.in_(missing_checksums),
+            ):
+                if embedding:
+                    plan["readd"][checksum] = decode_embedding(embedding, dtype)
+                else:
+                    plan["embed"][checksum] = sections[checksum]
+
+        # new sections
+        for checksum, section in sections.items():
+            if checksum not in stored_checksums:
+                plan["embed"][checksum] = section
 
-                    embedding = ast.literal_eval(
-                        existing_section.embedding
-                    ) or get_embedding(section)
-                    collection.add(
-                        embeddings=[embedding],
-                        documents=[section],
-                        metadatas=[{"article_id": article_id, "source": url}],
-                        ids=[checksum],
+        # sections that no longer exist (have changed), in the db or vector store
+        plan["removed"] = sorted(
+            (stored_checksums | indexed_checksums) - sections.keys()
+        )
+    return plan
+
+
+def store_sections(plans: List[dict]):
+    """
+    Write the sections of several diffed and embedded articles to the db and
+    the vector store in bulk
+    """
+    removed_sections = []
+    embeddings = []
+    documents = []
+    metadatas = []
+    ids = []
+
+    with session_scope() as db_session:
+        for plan in plans:
+            article_id = plan["article_id"]
+            if plan["embed"]:
+                # update stored sections that had no embedding, add the others
+                stored_sections = {
+                    s.checksum: s
+                    for s in db_session.query(Section).filter(
+                        Section.article_id == article_id,
+                        Section.checksum.in_(list(plan["embed"])),
                     )
-                continue
-
-            # If section with the same checksum does not exist, generate the embedding and save it
-            embedding = get_embedding(section)
-            new_section = Section(
-                article_id=article_id,
-                checksum=checksum,
-                content=section,
-                embedding=str(embedding),
-            )
-            # Save to the database
-            db_session.add(new_section)
-
-            # Add to lists for chroma
-            embeddings.append(embedding)
-            documents.append(section)
-            # todo: Add source url to metadata
-            metadatas.append({"article_id": article_id, "source": url})
-            ids.append(checksum)
-
-        # Delete sections for this article that no longer exist (have changed)
-        for existing_section in existing_sections:
-            if existing_section.checksum not in matched_existing_sections:
-                # add for removal from chroma if it exists there
-                if collection.get(existing_section.checksum):
-                    removed_sections.append(existing_section.checksum)
-                # Delete from the database
-                db_session.delete(existing_section)
+                }
+                for checksum, section in plan["embed"].items():
+                    embedding = plan["embeddings"][checksum]
+                    if checksum in stored_sections:
+                        stored_sections[checksum].embedding = encode_embedding(
+                            embedding
+                        )
+                        stored_sections[checksum].embedding_dtype = EMBEDDING_DTYPE
+                    else:
+                        db_session.add(
+                            Section(
+                                article_id=article_id,
+                                checksum=checksum,
+                                content=section,
+                                embedding=encode_embedding(embedding),
+                                embedding_dtype=EMBEDDING_DTYPE,
+                            )
+                        )
+            for checksum, embedding in list(plan["readd"].items()) + list(
+                plan["embeddings"].items()
+            ):
+                embeddings.append(embedding)
+                documents.append(plan["sections"][checksum])
+                metadatas.append(plan["metadata"])
+                ids.append(checksum)
+
+            if plan["removed"]:
+                db_session.query(Section).filter(
+                    Section.article_id == article_id,
+                    Section.checksum.in_(plan["removed"]),
+                ).delete(synchronize_session=False)
+                removed_sections += plan["removed"]
 
         # Delete removed sections from chroma
         if removed_sections:
@@ -281,33 +429,247 @@ def store_sections(sections: List[str], article: dict):
 
     # Add the new sections to chroma
     if ids:
+        if VECTOR_STORE == "chroma":
+            # chroma wants lists, not arrays
+            embeddings = [np.asarray(e, dtype=np.float32).tolist() for e in embeddings]
         collection.add(
             embeddings=embeddings, documents=documents, metadatas=metadatas, ids=ids
         )
 
 
-async def make_embeddings(force_update_all=False, force_update_ids=[]):
+async def process_articles(articles: List[dict], workers: int = WORKERS):
+    """
+    Streaming pipeline with bounded queues between the stages:
+    1. split and clean articles in a process pool, then diff them against the db
+    2. embed new sections, `workers` concurrent tasks batching across articles
+    3. a single writer storing the results in bulk
+    """
+    loop = asyncio.get_running_loop()
+    diffed = asyncio.Queue(maxsize=workers * 2)
+    embedded = asyncio.Queue(maxsize=workers * 2)
+
+    async def prepare(pool):
+        pending = set()
+
+        async def diff_done(done):
+            for future in done:
+                plan = diff_sections(*future.result())
+                if plan["embed"] or plan["readd"] or plan["removed"]:
+                    await diffed.put(plan)
+
+        for article in articles:
+            print(f'Article: {article["title"]} - {article["url"]}')
+            if len(pending) >= workers * 2:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                await diff_done(done)
+            pending.add(loop.run_in_executor(pool, prepare_article, article))
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            await diff_done(done)
+        for _ in range(workers):
+            await diffed.put(None)
+
+    async def embed():
+        finished = False
+        while not finished:
+            plan = await diffed.get()
+            if plan is None:
+                break
+            # grab whatever else is ready, so requests are batched across articles
+            plans = [plan]
+            size = len(plan["embed"])
+            while size < OPENAI_EMBEDDINGS_BATCH_SIZE and not diffed.empty():
+                plan = diffed.get_nowait()
+                if plan is None:
+                    finished = True
+                    break
+                plans.append(plan)
+                size += len(plan["embed"])
+            sections = [(p, c) for p in plans for c in p["embed"]]
+            if sections:
+                new_embeddings = await get_document_embeddings(
+                    [p["embed"][checksum] for p, checksum in sections]
+                )
+                for (p, checksum), embedding in zip(sections, new_embeddings):
+                    p["embeddings"][checksum] = embedding
+            for p in plans:
+                await embedded.put(p)
+
+    async def write():
+        while True:
+            plan = await embedded.get()
+            if plan is None:
+                break
+            plans = [plan]
+            while not embedded.empty():
+                plan = embedded.get_nowait()
+                if plan is None:
+                    store_sections(plans)
+                    return
+                plans.append(plan)
+            cprint(f"Storing sections of {len(plans)} articles", "blue")
+            store_sections(plans)
+
+    async def finish_embedding(embedders):
+        await asyncio.wait(embedders)
+        await embedded.put(None)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        embedders = [asyncio.create_task(embed()) for _ in range(workers)]
+        tasks = [
+            asyncio.create_task(prepare(pool)),
+            *embedders,
+            asyncio.create_task(finish_embedding(embedders)),
+            asyncio.create_task(write()),
+        ]
+        # a failing stage would leave the others waiting on its queue forever,
+        # so the first failure cancels the whole pipeline
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if task in done and not task.cancelled() and task.exception():
+                raise task.exception()
+
+
+def check_embeddings_model():
+    """
+    Embeddings from different models can't be compared: if the index was built
+    with another model, clear it and all stored embeddings so everything gets
+    embedded again. Returns True if the index needs to be rebuilt.
+    """
+    if not collection.count():
+        return False
+    # indexes from before the model was recorded were built with ada
+    index_model = (collection.metadata or {}).get(
+        "embeddings_model", "text-embedding-ada-002"
+    )
+    if index_model == EMBEDDINGS_MODEL:
+        return False
+    cprint(f"Index built with {index_model}, rebuilding with {EMBEDDINGS_MODEL}", "red")
+    collection.delete(ids=collection.get(include=[])["ids"])
+    with session_scope() as db_session:
+        db_session.query(Section).update(
+            {Section.embedding: None, Section.embedding_dtype: None}
+        )
+    return True
+
+
+@contextmanager
+def reindex_lock(lock_fd=None):
+    """
+    Held while reindexing, so only one process (e.g. one of several server
+    workers) reindexes at a time. Yields the locked file, None if another
+    process holds the lock. lock_fd is the lock file inherited from a parent
+    process holding the lock, which then stays held until both are done.
+    """
+    if lock_fd is None:
+        os.makedirs(os.path.dirname(REINDEX_LOCK_PATH), exist_ok=True)
+        lock_file = open(REINDEX_LOCK_PATH, "w")
+    else:
+        lock_file = os.fdopen(lock_fd, "w")
+    # (released when the file is closed by the last process that has it open)
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+        yield lock_file
+
+
+def remove_deleted_articles(article_ids):
+    """
+    Remove the sections of articles not in article_ids from the vector store
+    (store_articles removes them from the db)
+    """
+    article_ids = set(article_ids)
+    indexed = collection.get(include=["metadatas"])
+    removed = [
+        checksum
+        for checksum, metadata in zip(indexed["ids"], indexed["metadatas"])
+        if metadata and metadata["article_id"] not in article_ids
+    ]
+    if removed:
+        collection.delete(ids=removed)
+        cprint(f"Removed sections of deleted articles: {len(removed)}", "red")
+
+
+def build_lexical_index():
+    """
+    BM25 index of the sections in the vector store, saved with its next
+    snapshot (NumPy) or next to it (Chroma)
+    """
+    indexed = collection.get(include=["documents"])
+    index = BM25Index.build(zip(indexed["ids"], indexed["documents"]))
+    if VECTOR_STORE == "chroma":
+        index.save()
+    else:
+        collection.set_lexical_index(index)
+    cprint(f"Lexical index: {len(index.ids)} sections", "green")
+
+
+async def make_embeddings(force_update_all=False, force_update_ids=[], workers=WORKERS):
     from api.intercom import get_all_articles
 
+    create_tables()
     articles = await get_all_articles()
     # from sample_data import articles
 
-    updated_articles = store_articles(articles, force_update_ids=force_update_ids)
+    # only look at articles changed since the last sync
+    synced_updated_at = get_sync_state("articles_updated_at")
+    changed_articles = [
+        article
+        for article in articles
+        if synced_updated_at is None
+        or article["updated_at"] >= synced_updated_at
+        or int(article["id"]) in force_update_ids
+    ]
+    cprint(f"Changed articles: {len(changed_articles)}", "green")
+
+    updated_articles = get_updated_articles(changed_articles, force_update_ids)
     cprint(f"Updated articles: {len(updated_articles)}", "green")
 
-    loop_articles = updated_articles
-    if force_update_all:
-        loop_articles = [
-            article
-            for article in articles
-            if article["body"] and article["state"] == "published"
-        ]
+    # serving processes keep using the current index until this one is done
+    with deferred_persist(collection):
+        loop_articles = updated_articles
+        if check_embeddings_model():
+            force_update_all = True
+        if not collection.count():
+            # empty vector store (e.g. new backend): rebuild it, mostly from
+            # embeddings already stored in the db
+            force_update_all = True
+        if force_update_all:
+            loop_articles = [
+                article
+                for article in articles
+                if article["body"] and article["state"] == "published"
+            ]
+
+        await process_articles(loop_articles, workers=workers)
+        remove_deleted_articles(int(article["id"]) for article in articles)
+        build_lexical_index()
+
+        if (collection.metadata or {}).get("embeddings_model") != EMBEDDINGS_MODEL:
+            collection.modify(metadata={"embeddings_model": EMBEDDINGS_MODEL})
+
+    # only once the index is written: articles of a failed run are still behind
+    # in the db, so the next run picks them up again
+    store_articles(
+        changed_articles,
+        force_update_ids=force_update_ids,
+        article_ids=[int(article["id"]) for article in articles],
+    )
 
-    for article in loop_articles:
-        print(f'Article: {article["title"]} - {article["url"]}')
-        sections = make_sections(article)
-        print(f"Sections: {len(sections)}")
-        store_sections(sections, article)
+    if articles:
+        set_sync_state(
+            "articles_updated_at", max(article["updated_at"] for article in articles)
+        )
 
 
 if __name__ == "__main__":
@@ -317,7 +679,25 @@ if __name__ == "__main__":
         action="store_true",
         help="process sections from all articles, modified or not",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="worker processes for parsing and concurrent embedding requests",
+    )
     args = parser.parse_args()
 
-    # run the main coroutine with asyncio.run()
-    asyncio.run(make_embeddings(args.force_update))
+    async def run():
+        from api.intercom import close_session
+
+        try:
+            await make_embeddings(args.force_update, workers=args.workers)
+        finally:
+            await close_session()
+
+    with reindex_lock() as acquired:
+        if not acquired:
+            cprint("Another process is reindexing", "red")
+            sys.exit(REINDEX_LOCKED_EXIT_CODE)
+        # run the main coroutine with asyncio.run()
+        asyncio.run(run())
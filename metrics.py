@@ -0,0 +1,49 @@
+"""
+Simple in-process counters and timings, served as JSON on /metrics
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+counters = defaultdict(int)
+timings = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0})
+# current values, e.g. queue depth
+gauges = {}
+
+
+def increment(name, value=1):
+    counters[name] += value
+
+
+def set_gauge(name, value):
+    gauges[name] = value
+
+
+def observe(name, seconds):
+    timing = timings[name]
+    timing["count"] += 1
+    timing["total"] += seconds
+    timing["max"] = max(timing["max"], seconds)
+
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def get_metrics():
+    return {
+        "counters": dict(counters),
+        "gauges": dict(gauges),
+        "timings": {
+            name: {
+                **timing,
+                "avg": timing["total"] / timing["count"] if timing["count"] else 0,
+            }
+            for name, timing in timings.items()
+        },
+    }
@@ -0,0 +1,69 @@
+import json
+import time
+from sqlalchemy import text
+from termcolor import cprint
+from make_embeddings import (
+    EMBEDDING_DTYPE,
+    decode_embedding,
+    encode_embedding,
+    engine,
+)
+
+
+def migrate_embeddings(dtype=EMBEDDING_DTYPE):
+    """
+    One-shot migration of Section.embedding from str(list) text to packed binary
+    (also converts binary embeddings stored in a different dtype)
+    """
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        columns = [
+            row[1] for row in connection.execute(text("PRAGMA table_info(sections)"))
+        ]
+        if not columns:
+            return
+        if "embedding_dtype" not in columns:
+            connection.execute(
+                text("ALTER TABLE sections ADD COLUMN embedding_dtype VARCHAR")
+            )
+
+        rows = connection.execute(
+            text(
+                "SELECT id, embedding, typeof(embedding), embedding_dtype "
+                "FROM sections WHERE embedding IS NOT NULL "
+                "AND (typeof(embedding) = 'text' OR embedding_dtype IS NOT :dtype)"
+            ),
+            {"dtype": dtype},
+        ).fetchall()
+        updates = []
+        for id, embedding, embedding_type, embedding_dtype in rows:
+            if embedding_type == "text":
+                # str(list) of floats is valid json, and much faster to parse
+                values = json.loads(embedding)
+            else:
+                values = decode_embedding(embedding, embedding_dtype)
+            updates.append(
+                {
+                    "id": id,
+                    "embedding": encode_embedding(values, dtype)
+                    if len(values)
+                    else None,
+                    "dtype": dtype,
+                }
+            )
+        if updates:
+            connection.execute(
+                text(
+                    "UPDATE sections SET embedding = :embedding, "
+                    "embedding_dtype = :dtype WHERE id = :id"
+                ),
+                updates,
+            )
+    cprint(
+        f"Migrated {len(updates)} embeddings to {dtype} in {time.perf_counter() - start:.2f}s",
+        "green",
+    )
+
+
+if __name__ == "__main__":
+    migrate_embeddings()
@@ -0,0 +1,38 @@
+"""
+Fetch, embed and index the help center articles and remove sections of deleted
+articles, all in one new index snapshot. The server runs this in a separate
+process on startup, so it can serve from the current index meanwhile. Exits
+with 75 if another process is already reindexing.
+
+python reindex.py
+"""
+import argparse
+import asyncio
+import sys
+from termcolor import cprint
+
+from api.intercom import close_session
+from make_embeddings import REINDEX_LOCKED_EXIT_CODE, make_embeddings, reindex_lock
+
+
+async def reindex():
+    try:
+        await make_embeddings()
+    finally:
+        await close_session()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the article index.")
+    parser.add_argument(
+        "--lock-fd",
+        type=int,
+        help="reindex lock file inherited from the server process holding it",
+    )
+    args = parser.parse_args()
+
+    with reindex_lock(args.lock_fd) as acquired:
+        if not acquired:
+            cprint("Another process is reindexing", "red")
+            sys.exit(REINDEX_LOCKED_EXIT_CODE)
+        asyncio.run(reindex())
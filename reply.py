@@ -1,8 +1,23 @@
 import asyncio
+from collections import defaultdict
+import os
+import numpy as np
+import openai
 from termcolor import cprint
-from api.openai import OPENAI_MODEL, get_chat_completion
-from api.chroma import collection
-from make_embeddings import Section, session_scope
+from api.openai import (
+    OPENAI_MODEL,
+    OPENAI_RESPONSE_TOKENS,
+    count_message_tokens,
+    count_tokens,
+    get_chat_completion,
+    get_context_window,
+)
+from api.vector_store import VECTOR_STORE, collection
+from answer_cache import answer_cache, is_shareable
+from embeddings import EMBEDDINGS_MODEL, get_query_embedding, normalize_text
+from functions import functions
+from lexical_index import get_lexical_index, strip_html
+import metrics
 import argparse
 
 from prompt import system_prompt
@@ -12,63 +27,370 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+CONTEXT_HEADER = "Help article sections:\n"
+SECTION_SEPARATOR = "\n-\n"
+CONTEXT_N_RESULTS = int(os.getenv("CONTEXT_N_RESULTS", 10))
+# distances of relevant sections depend on the embedding model: ada-002 puts
+# everything close together, the others spread out more
+CONTEXT_MAX_DISTANCES = {
+    "text-embedding-ada-002": 0.3,
+    "text-embedding-3": 0.6,
+    "sentence-transformers/all-MiniLM": 0.6,
+    "sentence-transformers/all-mpnet": 0.6,
+}
+DEFAULT_CONTEXT_MAX_DISTANCE = 0.5
 
-async def get_answer(messages, skip_prep=False):
+
+def get_context_max_distance(model=EMBEDDINGS_MODEL):
+    # longest matching prefix, e.g. sentence-transformers/all-MiniLM-L6-v2
+    for prefix in sorted(CONTEXT_MAX_DISTANCES, key=len, reverse=True):
+        if model.startswith(prefix):
+            return CONTEXT_MAX_DISTANCES[prefix]
+    return DEFAULT_CONTEXT_MAX_DISTANCE
+
+
+# sections further from the question (cosine distance) never make it into the prompt
+CONTEXT_MAX_DISTANCE = float(
+    os.getenv("CONTEXT_MAX_DISTANCE", get_context_max_distance())
+)
+# without a question embedding to measure the distance, drop lexical matches
+# below this BM25 score (roughly one term found in 1 in 20 sections)
+CONTEXT_MIN_BM25_SCORE = float(os.getenv("CONTEXT_MIN_BM25_SCORE", 3.0))
+# sections this similar to a better match from the same article are dropped
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv("CONTEXT_DEDUP_SIMILARITY", 0.97))
+# rank fusion constant, the usual default
+RRF_K = 60
+# fall back to lexical search if embedding the question takes longer
+QUERY_EMBEDDING_TIMEOUT = float(os.getenv("QUERY_EMBEDDING_TIMEOUT", 5))
+# a cheaper/faster model is usually good enough to distill the question
+OPENAI_SUMMARY_MODEL = os.getenv("OPENAI_SUMMARY_MODEL", OPENAI_MODEL)
+# search with a lone first message directly instead of summarizing it
+SKIP_SINGLE_MESSAGE_SUMMARY = (
+    os.getenv("SKIP_SINGLE_MESSAGE_SUMMARY", "true").lower() == "true"
+)
+# search with the last message while the summary is being generated
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+
+
+async def get_answer(messages, skip_prep=False, on_function_call=None):
+    """
+    on_function_call(name) is called as soon as the reply turns out to be a
+    function call, before the completion is finished
+    """
     if not skip_prep:
-        # summarize the customer chat into one question for better search
-        question = await summarize_question(messages)
-        if "UNCLEAR" in question:
-            question = "\n".join([m["content"] for m in messages])
+        if SKIP_SINGLE_MESSAGE_SUMMARY and is_single_message(messages):
+            # nothing to distill from a single message, search with it directly
+            question = question_summary = get_message_text(messages[0])
+            metrics.increment("summaries_skipped")
+            retrieval_path = "unsummarized"
+            question_embedding, sections = await retrieve(question)
+        else:
+            (
+                question_summary,
+                question_embedding,
+                sections,
+            ) = await summarize_and_retrieve(messages)
+            question = question_summary
+            retrieval_path = "summarized"
         cprint(question, "magenta")
+        checksums = [section["checksum"] for section in sections]
+        # share of questions with at least one relevant section, per path
+        metrics.increment(f"retrieval_{retrieval_path}_total")
+        if sections:
+            metrics.increment(f"retrieval_{retrieval_path}_hits")
 
-        # take the question and search the most relevant embeddings
-        context_sections = get_context_sections(question)
+        # reuse the answer to the same question grounded on the same sections,
+        # only for opening questions: later answers depend on the conversation
+        cacheable = (
+            is_single_message(messages)
+            and "UNCLEAR" not in question_summary
+            and question_embedding is not None
+            and index_matches_embedding(question_embedding)
+        )
+        if cacheable:
+            customer_question = get_message_text(messages[0])
+            cached_answer = answer_cache.lookup(question_embedding, checksums)
+            if cached_answer:
+                cprint("Answer cache hit", "green")
+                return cached_answer, messages + [cached_answer]
 
-        if OPENAI_MODEL == "gpt-4":
-            max_chat_length = 20000
-        else:
-            max_chat_length = 10000
-        # could use tiktoken to count tokens instead of characters
-        if len(messages) + len(context_sections) > max_chat_length:
-            truncate_at = max_chat_length - len(messages)
-            context_sections = context_sections[:truncate_at] + "..."
+        # fill what's left of the context window with whole sections
+        budget = (
+            get_context_window(OPENAI_MODEL)
+            - OPENAI_RESPONSE_TOKENS
+            - count_message_tokens(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": CONTEXT_HEADER},
+                ]
+                + messages,
+                OPENAI_MODEL,
+                functions,
+            )
+        )
+        context_sections = pack_context_sections(sections, budget)
 
         messages = [
             {"role": "system", "content": system_prompt},
             {
                 "role": "system",
-                "content": "Help article sections:\n" + context_sections,
+                "content": CONTEXT_HEADER + context_sections,
             },
         ] + messages
     cprint(messages, "blue")
 
     # generate the reply
-    loop = asyncio.get_event_loop()
-    chat_completion, messages = await loop.run_in_executor(
-        None, get_chat_completion, messages
+    chat_completion, messages = await get_chat_completion(
+        messages, on_function_call=on_function_call
     )
+    if (
+        not skip_prep
+        and cacheable
+        and chat_completion.get("role") == "assistant"
+        and not chat_completion.get("function_call")
+        and is_shareable(chat_completion, customer_question, context_sections)
+    ):
+        answer_cache.store(question_embedding, checksums, chat_completion)
     return chat_completion, messages
 
 
-def get_context_sections(customer_chat):
-    search_results = collection.query(query_texts=[customer_chat], n_results=10)
-    with session_scope() as db_session:
-        sections = (
-            db_session.query(Section)
-            .filter(Section.checksum.in_(search_results["ids"][0]))
-            .all()
+def is_single_message(messages):
+    return len(messages) == 1 and messages[0]["role"] == "user"
+
+
+def get_message_text(message):
+    # strip the HTML and author label ("User: ") from a prepped message
+    text = " ".join(strip_html(message["content"]).split())
+    return text.split(": ", 1)[1] if text.startswith("User: ") else text
+
+
+async def retrieve(question):
+    """
+    Embed the question and search the most relevant sections
+    returns the embedding (None if embedding failed) and the sections
+    """
+    try:
+        question_embedding = await asyncio.wait_for(
+            get_query_embedding(question), QUERY_EMBEDDING_TIMEOUT
         )
-        context_sections = "\n-\n".join([section.content for section in sections])
-    return context_sections
+    except (openai.error.OpenAIError, asyncio.TimeoutError) as e:
+        # keep answering with lexical search only
+        cprint(f"Embedding the question failed: {e!r}", "red")
+        metrics.increment("query_embedding_failures")
+        question_embedding = None
+    sections = await get_context_sections(question, question_embedding)
+    return question_embedding, sections
+
+
+async def summarize_and_retrieve(messages):
+    """
+    Summarize the chat into one question and search with it. With
+    SPECULATIVE_RETRIEVAL, the last customer message is searched while the
+    summary is generated, and those results are used if the summary turns out
+    to be the same question, or if the chat has no clear question (UNCLEAR).
+    returns the summary, its embedding and the sections
+    """
+    speculative_task = None
+    last_message = next((m for m in reversed(messages) if m["role"] == "user"), None)
+    if SPECULATIVE_RETRIEVAL and last_message:
+        speculative_question = get_message_text(last_message)
+        speculative_task = asyncio.create_task(retrieve(speculative_question))
+
+    try:
+        with metrics.timer("summarize_question"):
+            question_summary = await summarize_question(messages)
+
+        if speculative_task is None:
+            if "UNCLEAR" in question_summary:
+                # search with the whole chat instead
+                question = "\n".join([m["content"] for m in messages])
+                return question_summary, *await retrieve(question)
+            return question_summary, *await retrieve(question_summary)
+
+        speculative_embedding, speculative_sections = await speculative_task
+        if "UNCLEAR" in question_summary or normalize_text(
+            question_summary
+        ) == normalize_text(speculative_question):
+            metrics.increment("speculative_retrieval_used")
+            return question_summary, speculative_embedding, speculative_sections
+
+        question_embedding, sections = await retrieve(question_summary)
+    finally:
+        # e.g. the summary failed: don't leave the search running
+        if speculative_task is not None and not speculative_task.cancel():
+            if not speculative_task.cancelled():
+                # (mark a failure as retrieved, it's raised from the await above)
+                speculative_task.exception()
+
+    # how much the speculative search agreed with the summary's
+    checksums = {s["checksum"] for s in sections}
+    speculative_checksums = {s["checksum"] for s in speculative_sections}
+    if checksums:
+        metrics.observe(
+            "speculative_retrieval_overlap",
+            len(checksums & speculative_checksums) / len(checksums),
+        )
+    return question_summary, question_embedding, sections
+
+
+def pack_context_sections(sections, max_tokens, model=OPENAI_MODEL):
+    """
+    Join as many sections as fit in max_tokens, in the given (relevance) order,
+    skipping the ones that don't fit rather than cutting them off mid-HTML
+    """
+    packed = []
+    tokens = 0
+    for section in sections:
+        section_tokens = count_tokens(SECTION_SEPARATOR + section["content"], model)
+        if tokens + section_tokens > max_tokens:
+            cprint(f"Context full, skipping section {section['checksum']}", "red")
+            continue
+        packed.append(section["content"])
+        tokens += section_tokens
+    return SECTION_SEPARATOR.join(packed)
+
+
+def index_matches_embedding(embedding):
+    """
+    Whether the index was built with the model questions are embedded with. Not
+    while it's being rebuilt for another one (e.g. EMBEDDINGS_BACKEND changed):
+    workers keep serving the old index until the new one is done.
+    """
+    # indexes from before the model was recorded were built with ada
+    index_model = (collection.metadata or {}).get(
+        "embeddings_model", "text-embedding-ada-002"
+    )
+    if index_model != EMBEDDINGS_MODEL:
+        return False
+    if VECTOR_STORE != "chroma" and collection.count():
+        return collection.embeddings.shape[1] == len(embedding)
+    return True
+
+
+def refresh_index():
+    """
+    Pick up a new index snapshot written by the indexer, dropping cached answers
+    grounded on sections it no longer has
+    """
+    if VECTOR_STORE != "chroma" and collection.refresh():
+        answer_cache.retain_sections(collection.ids)
+
+
+async def get_context_sections(customer_chat, embedding=None):
+    """
+    Hybrid search: vector and BM25 results fused with reciprocal rank fusion,
+    best match first. Lexical matches are held to CONTEXT_MAX_DISTANCE too,
+    or without an embedding (e.g. the embeddings API is down) to
+    CONTEXT_MIN_BM25_SCORE.
+    returns a list of dicts with checksum, content, article_id, (cosine) distance
+    and embedding, straight from the vector store (no db access)
+    """
+    refresh_index()
+    if embedding is not None and not index_matches_embedding(embedding):
+        # can't compare with the index's embeddings, search lexically only
+        cprint("Index from another embeddings model, skipping vector search", "red")
+        metrics.increment("index_model_mismatches")
+        embedding = None
+    include = ["documents", "metadatas", "embeddings"]
+    candidates = {}
+    rankings = []
+
+    if embedding is not None:
+        search_results = collection.query(
+            query_embeddings=[embedding],
+            n_results=CONTEXT_N_RESULTS,
+            include=include + ["distances"],
+        )
+        vector_ranking = []
+        for checksum, content, metadata, section_embedding, distance in zip(
+            search_results["ids"][0],
+            search_results["documents"][0],
+            search_results["metadatas"][0],
+            search_results["embeddings"][0],
+            search_results["distances"][0],
+        ):
+            if VECTOR_STORE == "chroma":
+                # squared l2 distance, for normalized embeddings that's 2x cosine distance
+                distance /= 2
+            if distance > CONTEXT_MAX_DISTANCE:
+                # results are ranked, the rest are even weaker matches
+                break
+            candidates[checksum] = make_candidate(
+                checksum, content, metadata, section_embedding, distance
+            )
+            vector_ranking.append(checksum)
+        rankings.append(vector_ranking)
+
+    lexical_index = get_lexical_index()
+    if lexical_index is not None:
+        lexical_ranking = [
+            checksum
+            for checksum, score in lexical_index.search(customer_chat, CONTEXT_N_RESULTS)
+            if embedding is not None or score >= CONTEXT_MIN_BM25_SCORE
+        ]
+        missing = [c for c in lexical_ranking if c not in candidates]
+        if missing:
+            if embedding is not None:
+                query = np.asarray(embedding, dtype=np.float32)
+                query /= np.linalg.norm(query) or 1
+            results = collection.get(ids=missing, include=include)
+            for checksum, content, metadata, section_embedding in zip(
+                results["ids"],
+                results["documents"],
+                results["metadatas"],
+                results["embeddings"],
+            ):
+                candidate = make_candidate(checksum, content, metadata, section_embedding)
+                if embedding is not None:
+                    candidate["distance"] = 1 - float(candidate["embedding"] @ query)
+                    if candidate["distance"] > CONTEXT_MAX_DISTANCE:
+                        continue
+                candidates[checksum] = candidate
+        rankings.append([c for c in lexical_ranking if c in candidates])
+
+    # reciprocal rank fusion
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, checksum in enumerate(ranking):
+            scores[checksum] += 1 / (RRF_K + rank + 1)
+    fused = sorted(scores, key=scores.get, reverse=True)
+
+    ranked_sections = []
+    for checksum in fused:
+        section = candidates[checksum]
+        if not section["content"]:
+            cprint(f"No content for section {checksum}, run make_embeddings", "red")
+            continue
+        # drop near-duplicates of a better match from the same article
+        if any(
+            s["article_id"] == section["article_id"]
+            and float(s["embedding"] @ section["embedding"]) >= CONTEXT_DEDUP_SIMILARITY
+            for s in ranked_sections
+        ):
+            continue
+        ranked_sections.append(section)
+        if len(ranked_sections) == CONTEXT_N_RESULTS:
+            break
+    return ranked_sections
+
+
+def make_candidate(checksum, content, metadata, embedding, distance=None):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return {
+        "checksum": checksum,
+        "content": content,
+        "article_id": metadata["article_id"] if metadata else None,
+        "distance": distance,
+        "embedding": embedding / (np.linalg.norm(embedding) or 1),
+    }
 
 
 async def summarize_question(messages):
     # send chat to openai to summarize
-    loop = asyncio.get_event_loop()
     system_prompt = """You are part of a customer service team. Distill the given customer service chat to just the question being currently asked, so that your colleagues have an easier time answering it. If you can't determine the question that is being asked, just say 'UNCLEAR'. Only return the summarized question without any intro or quotation marks, i.e. do not say \"The question being asked is: 'Can I speak to a human please?'\" but just \"Can I speak to a human please?\"."""
     messages = [{"role": "system", "content": system_prompt}] + messages
-    question, messages = await loop.run_in_executor(
-        None, lambda: get_chat_completion(messages, functions=None)
+    question, messages = await get_chat_completion(
+        messages, model=OPENAI_SUMMARY_MODEL, functions=None, stream=False
     )
     return question["content"]
 
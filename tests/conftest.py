@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# settings the modules read on import
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("REPLY_ADMIN_ID", "1")
+os.environ.setdefault("REINDEX_ON_STARTUP", "false")
+os.environ.setdefault(
+    "WORK_QUEUE_DB", os.path.join(tempfile.mkdtemp(), "work_queue.db")
+)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+import reply
+from answer_cache import AnswerCache
+
+SECTIONS = [
+    {
+        "checksum": "a",
+        "content": "<p>Reset your password from the login page.</p>",
+        "article_id": 1,
+        "distance": 0.1,
+    }
+]
+
+
+@pytest.fixture
+def answer(monkeypatch):
+    """
+    Calls get_answer with retrieval stubbed out and the completion returning
+    the given content. Returns (completion, whether the model was asked)
+    """
+    monkeypatch.setattr(reply, "answer_cache", AnswerCache(10, 60, 0.05))
+    monkeypatch.setattr(reply, "SKIP_SINGLE_MESSAGE_SUMMARY", True)
+    # (tiktoken downloads its encodings, count characters instead)
+    monkeypatch.setattr(reply, "count_tokens", lambda text, model=None: len(text))
+    monkeypatch.setattr(reply, "count_message_tokens", lambda *args: 0)
+
+    async def retrieve(question):
+        return [1.0, 0.0], SECTIONS
+
+    async def summarize_and_retrieve(messages):
+        return "How do I reset my password?", [1.0, 0.0], SECTIONS
+
+    monkeypatch.setattr(reply, "retrieve", retrieve)
+    monkeypatch.setattr(reply, "summarize_and_retrieve", summarize_and_retrieve)
+
+    def answer(messages, content):
+        completions = []
+
+        async def get_chat_completion(messages, on_function_call=None):
+            completion = {"role": "assistant", "content": content}
+            completions.append(completion)
+            return completion, messages + [completion]
+
+        monkeypatch.setattr(reply, "get_chat_completion", get_chat_completion)
+        completion, _ = asyncio.run(reply.get_answer(messages))
+        return completion, bool(completions)
+
+    return answer
+
+
+def user_message(text):
+    return [{"role": "user", "content": f"User: {text}"}]
+
+
+def test_generic_first_answer_is_reused(answer):
+    question = user_message("how do I reset my password?")
+    content = "You can reset it from the login page."
+    assert answer(question, content) == ({"role": "assistant", "content": content}, True)
+    assert answer(question, "other") == ({"role": "assistant", "content": content}, False)
+
+
+@pytest.mark.parametrize(
+    "content",
+    ["SKIP", "Glad I could help! CLOSE"],
+)
+def test_control_replies_are_not_cached(answer, content):
+    question = user_message("thanks, that worked")
+    answer(question, content)
+    assert answer(question, "other")[1]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "Hi Dana, you can reset it from the login page.",
+        "Account 48213 can be reset from the login page.",
+    ],
+)
+def test_personal_answers_are_not_cached(answer, content):
+    question = user_message("I'm Dana, account 48213, how do I reset my password?")
+    answer(question, content)
+    assert answer(question, "other")[1]
+
+
+def test_later_turns_are_not_cached(answer):
+    conversation = [
+        {"role": "user", "content": "User: hi"},
+        {"role": "assistant", "content": "Hi! How can I help?"},
+        {"role": "user", "content": "User: how do I reset my password?"},
+    ]
+    answer(conversation, "You can reset it from the login page.")
+    assert answer(conversation, "other")[1]
+    # nor reused for them
+    answer(user_message("how do I reset my password?"), "first")
+    assert answer(conversation, "other")[1]
+
+
+def test_retain_sections_drops_answers_on_removed_sections():
+    cache = AnswerCache(10, 60, 0.05)
+    cache.store([1.0, 0.0], ["a", "b"], {"role": "assistant", "content": "ab"})
+    cache.store([0.0, 1.0], ["c"], {"role": "assistant", "content": "c"})
+    cache.retain_sections(["b", "c"])
+    assert cache.lookup([1.0, 0.0], ["a", "b"]) is None
+    assert cache.lookup([0.0, 1.0], ["c"]) == {"role": "assistant", "content": "c"}
@@ -0,0 +1,59 @@
+import asyncio
+
+import main
+from conversation_cache import ConversationCache
+
+
+def make_part(part_id, body):
+    return {
+        "id": part_id,
+        "part_type": "comment",
+        "body": f"<p>{body}</p>",
+        "author": {"type": "user", "id": "customer"},
+    }
+
+
+def make_item(parts, total_count):
+    return {
+        "type": "conversation",
+        "id": "1",
+        "source": {"body": "<p>hi</p>", "author": {"type": "user", "id": "customer"}},
+        "conversation_parts": {"conversation_parts": parts, "total_count": total_count},
+    }
+
+
+def test_get_rejects_parts_behind_the_payload():
+    cache = ConversationCache(10, 60)
+    cache.store("1", [make_part("a", "one"), make_part("b", "two")])
+    assert cache.get("1", total_count=2, last_part_id="b")
+    assert cache.get("1", total_count=3, last_part_id="c") is None
+    assert cache.get("1", total_count=2, last_part_id="c") is None
+
+
+def test_stale_cache_is_refetched(monkeypatch):
+    parts = [make_part("a", "one"), make_part("b", "two"), make_part("c", "three")]
+    fetches = []
+
+    async def get_conversation(conversation_id):
+        fetches.append(conversation_id)
+        return make_item(parts, len(parts))
+
+    monkeypatch.setattr(main, "conversation_cache", ConversationCache(10, 60))
+    monkeypatch.setattr(main, "get_conversation", get_conversation)
+    # cached by another reply before the customer's latest messages
+    main.conversation_cache.store("1", parts[:1])
+
+    # a webhook only carrying the latest part, the one before is missing
+    messages = asyncio.run(main.prep_conversation(make_item(parts[2:], 3)))
+    assert fetches == ["1"]
+    assert [m["content"] for m in messages[1:]] == [
+        "User: <p>one</p>",
+        "User: <p>two</p>",
+        "User: <p>three</p>",
+    ]
+
+    # a webhook adding to the complete transcript is answered from the cache
+    parts.append(make_part("d", "four"))
+    messages = asyncio.run(main.prep_conversation(make_item(parts[3:], 4)))
+    assert fetches == ["1"]
+    assert messages[-1]["content"] == "User: <p>four</p>"
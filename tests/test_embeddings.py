@@ -0,0 +1,53 @@
+import asyncio
+import numpy as np
+
+import embeddings
+from api import local_embeddings
+
+
+def test_repeat_local_query_is_served_from_cache(monkeypatch):
+    calls = []
+
+    async def fake_get_embeddings(texts, model_name=None):
+        calls.append(texts)
+        return list(np.ones((len(texts), 4), dtype=np.float32) / 2)
+
+    monkeypatch.setattr(embeddings, "EMBEDDINGS_BACKEND", "local")
+    monkeypatch.setattr(local_embeddings, "get_embeddings", fake_get_embeddings)
+    monkeypatch.setattr(
+        embeddings, "query_embedding_cache", embeddings.EmbeddingCache(10, 60)
+    )
+
+    first = asyncio.run(embeddings.get_query_embedding("How do I reset?", "local"))
+    second = asyncio.run(embeddings.get_query_embedding("how do i reset", "local"))
+
+    assert first == second == [0.5] * 4
+    assert isinstance(second, list)
+    assert len(calls) == 1
+
+
+def count_rows(cache):
+    return cache.db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+
+
+def test_db_cache_drops_expired_and_least_recently_used_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBEDDING_CACHE_DB_SWEEP_EVERY", 1)
+    now = [1000.0]
+    monkeypatch.setattr(embeddings.time, "time", lambda: now[0])
+    db_path = str(tmp_path / "embedding_cache.db")
+
+    cache = embeddings.EmbeddingCache(10, 60, db_path, db_max_size=3)
+    for question in ["a", "b", "c"]:
+        cache.set(question, "model", [1.0])
+        now[0] += 1
+    # used last, from a new process with an empty memory cache
+    assert embeddings.EmbeddingCache(10, 60, db_path).get("a", "model") == [1.0]
+    cache.set("d", "model", [1.0])
+    assert count_rows(cache) == 3
+    assert embeddings.EmbeddingCache(10, 60, db_path).get("b", "model") is None
+
+    now[0] += 60
+    # "a" and "c" expired, deleted when read or swept
+    assert embeddings.EmbeddingCache(0, 60, db_path).get("a", "model") is None
+    cache.set("e", "model", [1.0])
+    assert count_rows(cache) == 2
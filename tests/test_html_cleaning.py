@@ -0,0 +1,41 @@
+import pytest
+
+from html_cleaning import clean_section, wrap_paragraphs
+
+# what the BeautifulSoup (html.parser) versions returned, stored section
+# checksums depend on it
+CASES = [
+    ('<img src="a.png" alt="b">', '<img alt="b" src="a.png"/>'),
+    (
+        '<p>x<iframe src="v" allowfullscreen></iframe></p>',
+        '<p>x<iframe allowfullscreen="" src="v"></iframe></p>',
+    ),
+    (
+        '<input type="checkbox" checked disabled>',
+        '<input checked="" disabled="" type="checkbox"/>',
+    ),
+    (
+        '<select multiple><option selected="x" value="1">a</option></select>',
+        '<select multiple=""><option selected="x" value="1">a</option></select>',
+    ),
+    ('<p>a<!-- c -->b</p>', "<p>a<!-- c -->b</p>"),
+]
+
+
+@pytest.mark.parametrize("content, expected", CASES)
+def test_serialized_like_beautifulsoup(content, expected):
+    assert clean_section(content) == expected
+    assert wrap_paragraphs(content) == expected
+
+
+def test_comments_stay_in_their_paragraph():
+    assert wrap_paragraphs("text<!-- c -->more") == "<p>text<!-- c -->more</p>"
+    assert wrap_paragraphs("<b>x</b><!-- c --><div>y</div>") == (
+        "<p><b>x</b><!-- c --></p><div>y</div>"
+    )
+
+
+def test_clean_section_removes_class_id_and_empty_paragraphs():
+    assert clean_section(
+        '<h2 id="a" class="b" title="t">Setup</h2>\n<p class="c"> </p>\n<p>Go</p>'
+    ) == '<h2 title="t">Setup</h2><p>Go</p>'
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def get(monkeypatch):
+    monkeypatch.setattr(main, "METRICS_SECRET", "s3cret")
+
+    def get(path, headers=None):
+        async def request():
+            response = await main.app.test_client().get(path, headers=headers)
+            return response.status_code
+
+        return asyncio.run(request())
+
+    return get
+
+
+def test_metrics_require_the_secret(get):
+    assert get("/metrics") == 403
+    assert get("/metrics?secret=wrong") == 403
+    assert get("/metrics", headers={"X-Metrics-Secret": "s3cret"}) == 200
+    assert get("/metrics?secret=s3cret") == 200
+
+
+def test_metrics_are_off_without_a_secret(get, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_SECRET", None)
+    assert get("/metrics") == 403
+    assert get("/metrics?secret=") == 403
+
+
+def make_webhook(conversation_id, total_count):
+    return {
+        "data": {
+            "item": {
+                "type": "conversation",
+                "id": conversation_id,
+                "admin_assignee_id": None,
+                "team_assignee_id": None,
+                "source": {
+                    "body": "<p>hi</p>",
+                    "author": {"type": "user", "id": "customer"},
+                },
+                "conversation_parts": {
+                    "conversation_parts": [],
+                    "total_count": total_count,
+                },
+            }
+        }
+    }
+
+
+@pytest.mark.parametrize("total_count, completions", [(0, 1), (2, 2)])
+def test_coalesced_webhooks_count_the_completions_saved(
+    monkeypatch, total_count, completions
+):
+    async def validate_intercom_request(request):
+        return True
+
+    monkeypatch.setattr(main, "validate_intercom_request", validate_intercom_request)
+    monkeypatch.setattr(main, "SKIP_SINGLE_MESSAGE_SUMMARY", True)
+    monkeypatch.setattr(main.metrics, "counters", main.metrics.defaultdict(int))
+    conversation_id = f"coalesced-{total_count}"
+
+    async def post_webhooks():
+        client = main.app.test_client()
+        for count in [total_count, total_count + 1]:
+            await client.post("/webhook", json=make_webhook(conversation_id, count))
+
+    asyncio.run(post_webhooks())
+    # the first webhook's reply was never generated
+    assert main.metrics.counters["webhooks_coalesced"] == 1
+    assert main.metrics.counters["completions_saved"] == completions
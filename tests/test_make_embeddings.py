@@ -0,0 +1,135 @@
+import asyncio
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import make_embeddings
+
+
+def make_article(article_id):
+    return {
+        "id": article_id,
+        "title": f"Article {article_id}",
+        "description": "",
+        "url": f"https://example.com/{article_id}",
+        "body": f"<h2>Heading</h2><p>Text of article {article_id}</p>",
+        "state": "published",
+        "updated_at": 1,
+    }
+
+
+def test_failing_stage_stops_the_pipeline(monkeypatch):
+    stored = []
+
+    def diff_sections(article, sections):
+        return {
+            "article_id": article["id"],
+            "embed": dict(sections),
+            "embeddings": {},
+            "readd": {},
+            "removed": [],
+        }
+
+    async def get_document_embeddings(texts):
+        raise RuntimeError("embeddings API down")
+
+    monkeypatch.setattr(make_embeddings, "diff_sections", diff_sections)
+    monkeypatch.setattr(
+        make_embeddings, "get_document_embeddings", get_document_embeddings
+    )
+    monkeypatch.setattr(make_embeddings, "store_sections", stored.extend)
+
+    # more articles than the queues hold, so the other stages are blocked on them
+    articles = [make_article(i) for i in range(50)]
+    with pytest.raises(RuntimeError, match="embeddings API down"):
+        asyncio.run(
+            asyncio.wait_for(make_embeddings.process_articles(articles, workers=2), 30)
+        )
+    assert stored == []
+
+
+def test_store_articles_stays_below_the_bound_parameter_limit(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'articles.db'}")
+
+    @event.listens_for(engine, "connect")
+    def limit_variables(connection, _):
+        # the default before SQLite 3.32
+        connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+
+    monkeypatch.setattr(make_embeddings, "engine", engine)
+    monkeypatch.setattr(make_embeddings, "Session", sessionmaker(bind=engine))
+
+    articles = [make_article(i) for i in range(1500)]
+    assert len(make_embeddings.store_articles(articles)) == 1500
+    make_embeddings.store_articles(articles[:10])
+    with make_embeddings.session_scope() as db_session:
+        stored_ids = [id for id, in db_session.query(make_embeddings.Article.id)]
+    assert sorted(stored_ids) == list(range(10))
+
+
+@pytest.fixture
+def reindex(tmp_path, monkeypatch):
+    """
+    make_embeddings with its own db and index, the articles and embeddings
+    stubbed. Returns a function running it with the given articles.
+    """
+    import api.intercom
+    from api.vector_store import NumpyCollection
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'articles.db'}")
+    monkeypatch.setattr(make_embeddings, "engine", engine)
+    monkeypatch.setattr(make_embeddings, "Session", sessionmaker(bind=engine))
+    monkeypatch.setattr(
+        make_embeddings, "collection", NumpyCollection(str(tmp_path / "vectors"))
+    )
+
+    def run(articles, embeddings_fail=False):
+        async def get_all_articles():
+            return articles
+
+        async def get_document_embeddings(texts):
+            if embeddings_fail:
+                raise RuntimeError("embeddings API down")
+            return [[1.0, float(len(text))] for text in texts]
+
+        monkeypatch.setattr(api.intercom, "get_all_articles", get_all_articles)
+        monkeypatch.setattr(
+            make_embeddings, "get_document_embeddings", get_document_embeddings
+        )
+        asyncio.run(make_embeddings.make_embeddings(workers=1))
+
+    return run
+
+
+def test_articles_of_a_failed_reindex_are_reindexed(reindex):
+    articles = [make_article(1), make_article(2)]
+    reindex(articles)
+
+    articles[0] = {**articles[0], "body": "<p>alpha</p>", "updated_at": 2}
+    with pytest.raises(RuntimeError):
+        reindex(articles, embeddings_fail=True)
+    assert not any(
+        "alpha" in document
+        for document in make_embeddings.collection.get()["documents"]
+    )
+
+    reindex(articles)
+    documents = make_embeddings.collection.get(where={"article_id": 1})["documents"]
+    assert len(documents) == 1 and "alpha" in documents[0]
+
+
+def test_reindex_publishes_one_snapshot_with_its_lexical_index(reindex):
+    articles = [make_article(1), make_article(2)]
+    reindex(articles)
+    collection = make_embeddings.collection
+    version = collection.version
+
+    reindex([{**articles[0], "body": "<p>alpha</p>", "updated_at": 2}])
+    assert collection.version == version + 1
+    # what serving processes load
+    snapshot = type(collection)(collection.persist_directory)
+    assert snapshot.get(where={"article_id": 2})["ids"] == []
+    assert sorted(snapshot.lexical_index.ids) == sorted(snapshot.ids)
+    assert [id for id, _ in snapshot.lexical_index.search("alpha")] == snapshot.ids
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+import make_embeddings
+from make_embeddings import reindex_lock
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def lock_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(make_embeddings, "REINDEX_LOCK_PATH", str(tmp_path / "lock"))
+
+
+def test_only_one_process_gets_the_lock():
+    with reindex_lock() as lock_file:
+        assert lock_file is not None
+        with reindex_lock() as other:
+            assert other is None
+    with reindex_lock() as lock_file:
+        assert lock_file is not None
+
+
+def test_concurrent_reindexes_start_one_process(monkeypatch):
+    started = []
+
+    class Process:
+        async def wait(self):
+            await asyncio.sleep(0.1)
+            return 0
+
+    async def create_subprocess_exec(*args, pass_fds=(), **kwargs):
+        started.append(args)
+        # the lock is still held while the child runs
+        with reindex_lock() as other:
+            assert other is None
+        assert args[-1] == str(pass_fds[0])
+        return Process()
+
+    monkeypatch.setattr(main.asyncio, "create_subprocess_exec", create_subprocess_exec)
+    monkeypatch.setattr(main, "refresh_index", lambda: None)
+
+    async def run():
+        await asyncio.gather(main.reindex(), main.reindex(), main.reindex())
+
+    asyncio.run(run())
+    assert len(started) == 1
+    assert main.reindex_status["exit_code"] == 0
+
+
+def test_child_keeps_the_inherited_lock():
+    child_script = (
+        "import sys\n"
+        "from make_embeddings import reindex_lock\n"
+        "with reindex_lock(int(sys.argv[1])) as lock_file:\n"
+        "    print(lock_file is not None, flush=True)\n"
+        "    sys.stdin.read()\n"
+    )
+    with reindex_lock() as lock_file:
+        child = subprocess.Popen(
+            [sys.executable, "-c", child_script, str(lock_file.fileno())],
+            cwd=REPO_DIRECTORY,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            pass_fds=[lock_file.fileno()],
+            text=True,
+        )
+    try:
+        assert child.stdout.readline() == "True\n"
+        # the parent let go, the child still holds it
+        with reindex_lock() as other:
+            assert other is None
+    finally:
+        child.communicate("")
+    with reindex_lock() as lock_file:
+        assert lock_file is not None
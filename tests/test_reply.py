@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+import reply
+from api.vector_store import NumpyCollection
+from lexical_index import BM25Index
+
+SECTIONS = {
+    # (content, embedding)
+    "close": ("<p>How to reset your password</p>", [1.0, 0.0, 0.0]),
+    "keyword": ("<p>Error E1234 when you reset the account</p>", [0.8, 0.6, 0.0]),
+    "far": ("<p>Error E1234 in the billing export</p>", [0.0, 0.0, 1.0]),
+    "common": ("<p>You can find it in the app</p>", [0.0, 1.0, 0.0]),
+}
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    collection = NumpyCollection(str(tmp_path))
+    collection.add(
+        ids=list(SECTIONS),
+        embeddings=[embedding for _, embedding in SECTIONS.values()],
+        documents=[content for content, _ in SECTIONS.values()],
+        metadatas=[{"article_id": i} for i in range(len(SECTIONS))],
+    )
+    collection.modify(metadata={"embeddings_model": reply.EMBEDDINGS_MODEL})
+    # enough filler for the idf of rare terms to stand out from common ones
+    lexical_index = BM25Index.build(
+        [(checksum, content) for checksum, (content, _) in SECTIONS.items()]
+        + [(f"filler{i}", "<p>You can find it in the app</p>") for i in range(100)]
+    )
+    monkeypatch.setattr(reply, "collection", collection)
+    monkeypatch.setattr(reply, "get_lexical_index", lambda: lexical_index)
+    monkeypatch.setattr(reply, "CONTEXT_MAX_DISTANCE", 0.3)
+    monkeypatch.setattr(reply, "CONTEXT_MIN_BM25_SCORE", 3.0)
+
+
+def get_checksums(question, embedding):
+    sections = asyncio.run(reply.get_context_sections(question, embedding))
+    return [section["checksum"] for section in sections]
+
+
+def test_lexical_matches_are_held_to_the_distance_cutoff(index):
+    # "keyword" is only found by BM25 (the vector search stops at "close"), and
+    # kept as it's close enough, unlike "far" with the same error code
+    checksums = get_checksums("reset password E1234", [1.0, 0.0, 0.0])
+    assert checksums == ["close", "keyword"]
+
+
+def test_common_words_bring_in_nothing_without_an_embedding(index):
+    assert get_checksums("can you find it in the app", None) == []
+    assert get_checksums("E1234", None) == ["far", "keyword"]
+
+
+def test_index_from_another_model_is_searched_lexically(index):
+    # a query embedding from the new model, the index still has the old one's
+    assert get_checksums("E1234", [1.0, 0.0, 0.0, 0.0]) == ["far", "keyword"]
+    reply.collection.modify(metadata={"embeddings_model": "some/other-model"})
+    assert get_checksums("E1234", [1.0, 0.0, 0.0]) == ["far", "keyword"]
+    assert not reply.index_matches_embedding([1.0, 0.0, 0.0])
+
+
+def test_context_cutoff_depends_on_the_embedding_model():
+    assert reply.get_context_max_distance("text-embedding-ada-002") == 0.3
+    assert reply.get_context_max_distance("sentence-transformers/all-MiniLM-L6-v2") == 0.6
+    assert (
+        reply.get_context_max_distance("some/other-model")
+        == reply.DEFAULT_CONTEXT_MAX_DISTANCE
+    )
+
+
+CHAT = [
+    {"role": "user", "content": "User: hi"},
+    {"role": "assistant", "content": "Hi! How can I help?"},
+    {"role": "user", "content": "User: it doesn't work"},
+]
+
+
+@pytest.fixture
+def speculative(monkeypatch):
+    """
+    Stubs retrieval, records the questions searched with
+    """
+    searches = []
+
+    async def retrieve(question):
+        searches.append(question)
+        await asyncio.sleep(0.01)
+        return [1.0], [{"checksum": question}]
+
+    monkeypatch.setattr(reply, "SPECULATIVE_RETRIEVAL", True)
+    monkeypatch.setattr(reply, "retrieve", retrieve)
+    return searches
+
+
+def test_unclear_summary_reuses_the_speculative_search(speculative, monkeypatch):
+    async def summarize_question(messages):
+        return "UNCLEAR"
+
+    monkeypatch.setattr(reply, "summarize_question", summarize_question)
+    result = asyncio.run(reply.summarize_and_retrieve(CHAT))
+    assert result == ("UNCLEAR", [1.0], [{"checksum": "it doesn't work"}])
+    assert speculative == ["it doesn't work"]
+
+
+def test_failed_summary_cancels_the_speculative_search(speculative, monkeypatch):
+    async def summarize_question(messages):
+        raise RuntimeError("summary failed")
+
+    monkeypatch.setattr(reply, "summarize_question", summarize_question)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await reply.summarize_and_retrieve(CHAT)
+        # nothing left running
+        await asyncio.sleep(0)
+        return [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
@@ -0,0 +1,55 @@
+import os
+
+from api.vector_store import NumpyCollection
+
+
+def add_sections(collection, article_id, checksums):
+    collection.add(
+        ids=checksums,
+        embeddings=[[1.0, float(i)] for i in range(len(checksums))],
+        documents=[f"<p>{checksum}</p>" for checksum in checksums],
+        metadatas=[{"article_id": article_id, "source": "url"} for _ in checksums],
+    )
+
+
+def get_ids(collection, **kwargs):
+    return collection.get(include=[], **kwargs)["ids"]
+
+
+def test_where_filter_follows_changes(tmp_path):
+    collection = NumpyCollection(str(tmp_path))
+    add_sections(collection, 1, ["a", "b"])
+    add_sections(collection, 2, ["c"])
+    assert get_ids(collection, where={"article_id": 1}) == ["a", "b"]
+
+    with collection.deferred_persist():
+        add_sections(collection, 1, ["d"])
+        assert get_ids(collection, where={"article_id": 1}) == ["a", "b", "d"]
+        collection.delete(ids=["a"])
+        assert get_ids(collection, where={"article_id": 1}) == ["b", "d"]
+        collection.update(ids=["c"], metadatas=[{"article_id": 1, "source": "url"}])
+        assert get_ids(collection, where={"article_id": 1}) == ["b", "c", "d"]
+        assert get_ids(collection, where={"article_id": 2}) == []
+
+    assert get_ids(collection, where={"article_id": 1}) == ["b", "c", "d"]
+    assert get_ids(collection, ids=["d", "b", "x"], where={"article_id": 1}) == ["d", "b"]
+    assert get_ids(collection, where={"article_id": 1, "source": "other"}) == []
+    assert collection.query(
+        query_embeddings=[[1.0, 1.0]], n_results=1, where={"article_id": 1}
+    )["ids"] == [["b"]]
+
+
+def test_deferred_changes_write_one_snapshot(tmp_path):
+    collection = NumpyCollection(str(tmp_path))
+    add_sections(collection, 1, ["a"])
+    version = collection.version
+    with collection.deferred_persist():
+        for i in range(5):
+            add_sections(collection, 2, [f"s{i}"])
+        collection.update(ids=["s0"], embeddings=[[0.0, 1.0]])
+    assert collection.version == version + 1
+    assert sorted(os.listdir(tmp_path / "snapshots")) == [
+        str(version),
+        str(version + 1),
+    ]
+    assert collection.count() == 6
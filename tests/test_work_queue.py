@@ -0,0 +1,182 @@
+import asyncio
+import time
+
+import pytest
+
+import work_queue
+from work_queue import DEAD, RUNNING, WorkQueue
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, "POLL_SECONDS", 0.05)
+    return str(tmp_path / "work_queue.db")
+
+
+async def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def payload(text):
+    return {"text": text}
+
+
+def test_claim_takes_due_jobs_one_per_conversation(db_path):
+    async def run():
+        queue = WorkQueue(db_path)
+        await queue.enqueue(1, payload("a"))
+        await queue.enqueue(2, payload("b"), delay=60)
+        first = await queue.claim()
+        assert (first[1], first[2]) == ("1", '{"text": "a"}')
+        # the second replaces the waiting one, neither runs while the first does
+        assert await queue.enqueue(1, payload("c")) is None
+        assert await queue.enqueue(1, payload("d")) == payload("c")
+        assert await queue.claim() is None
+        await queue.run(queue.delete, first[0])
+        second = await queue.claim()
+        assert (second[1], second[2]) == ("1", '{"text": "d"}')
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("poll", [True, False])
+def test_newer_job_in_another_process_supersedes_running_job(
+    db_path, monkeypatch, poll
+):
+    if not poll:
+        # noticed on release, before the first poll
+        monkeypatch.setattr(work_queue, "POLL_SECONDS", 60)
+    posted = []
+    started = []
+
+    async def run():
+        worker = WorkQueue(db_path)
+        # the webhook of the newer message lands on another worker process
+        other = WorkQueue(db_path)
+        proceed = asyncio.Event()
+
+        async def handler(data):
+            started.append(data["text"])
+            if data["text"] == "old":
+                await proceed.wait()
+            await worker.release()
+            posted.append(data["text"])
+
+        await worker.start(handler, workers=1)
+        await worker.enqueue(1, payload("old"))
+        await wait_until(lambda: started)
+        await other.enqueue(1, payload("new"))
+        if poll:
+            await wait_until(lambda: "new" in posted)
+        proceed.set()
+        await wait_until(lambda: "new" in posted)
+        await worker.stop()
+        return await worker.run(worker.query, "SELECT COUNT(*) FROM jobs")
+
+    assert asyncio.run(run()) == [(0,)]
+    assert posted == ["new"]
+
+
+def test_failed_jobs_are_retried_then_dead_lettered(db_path, monkeypatch):
+    monkeypatch.setattr(work_queue, "BACKOFF_BASE", 0)
+    monkeypatch.setattr(work_queue, "WORK_QUEUE_MAX_ATTEMPTS", 3)
+    attempts = []
+
+    async def run():
+        queue = WorkQueue(db_path)
+
+        async def handler(data):
+            attempts.append(data["text"])
+            if data["text"] == "fails" or len(attempts) < 2:
+                raise RuntimeError("API down")
+
+        await queue.start(handler, workers=1)
+        await queue.enqueue(1, payload("recovers"))
+        await wait_until(lambda: attempts == ["recovers"] * 2)
+        await queue.enqueue(2, payload("fails"))
+        await wait_until(lambda: attempts.count("fails") == 3)
+        await asyncio.sleep(0.2)
+        await queue.stop()
+        return await queue.run(
+            queue.query, "SELECT conversation_id, status, attempts FROM jobs"
+        )
+
+    assert asyncio.run(run()) == [("2", DEAD, 3)]
+    assert attempts.count("fails") == 3
+
+
+def test_recover_requeues_jobs_of_dead_processes(db_path):
+    async def run():
+        queue = WorkQueue(db_path)
+        await queue.enqueue(1, payload("a"))
+        await queue.enqueue(2, payload("b"))
+        interrupted = await queue.claim()
+        superseded = await queue.claim()
+        await queue.enqueue(2, payload("c"))
+        for job in [interrupted, superseded]:
+            # left running by a process that is gone
+            await queue.run(queue.set_status, job[0], RUNNING, worker_pid=2**22 + 1)
+        await queue.run(queue.recover)
+        return await queue.run(
+            queue.query, "SELECT conversation_id, payload, status FROM jobs ORDER BY id"
+        )
+
+    assert asyncio.run(run()) == [
+        ("1", '{"text": "a"}', "queued"),
+        ("2", '{"text": "c"}', "queued"),
+    ]
+
+
+def test_jobs_interrupted_by_shutdown_are_queued_again(db_path):
+    async def run():
+        queue = WorkQueue(db_path)
+        started = []
+
+        async def handler(data):
+            started.append(data["text"])
+            await asyncio.sleep(60)
+
+        await queue.start(handler, workers=1)
+        await queue.enqueue(1, payload("a"))
+        await wait_until(lambda: started)
+        await queue.stop(timeout=0.2)
+        # another worker process can answer it right away
+        return await WorkQueue(db_path).claim()
+
+    job = asyncio.run(run())
+    assert (job[1], job[2]) == ("1", '{"text": "a"}')
+
+
+def test_jobs_of_crashed_worker_processes_are_recovered_while_running(
+    db_path, monkeypatch
+):
+    monkeypatch.setattr(work_queue, "WORK_QUEUE_RECOVER_SECONDS", 0.1)
+    posted = []
+
+    async def run():
+        # claimed by another worker process, alive when this one starts
+        other = await asyncio.create_subprocess_exec("sleep", "60")
+        crashed = WorkQueue(db_path)
+        await crashed.enqueue(1, payload("a"))
+        job = await crashed.claim()
+        await crashed.run(crashed.set_status, job[0], RUNNING, worker_pid=other.pid)
+
+        queue = WorkQueue(db_path)
+
+        async def handler(data):
+            await queue.release()
+            posted.append(data["text"])
+
+        await queue.start(handler, workers=1)
+        await asyncio.sleep(0.2)
+        assert posted == []
+        other.kill()
+        await other.wait()
+        await wait_until(lambda: posted)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert posted == ["a"]
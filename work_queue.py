@@ -0,0 +1,440 @@
+"""
+Durable work queue for webhooks. Jobs are stored in SQLite, so a deploy or a
+crash doesn't drop conversations in flight, and processed by a bounded pool of
+workers, so a spike doesn't start unlimited parallel completions.
+
+- jobs of the same conversation run one at a time, in order
+- a job enqueued while another one of its conversation is still waiting
+  replaces it (one reply for rapid-fire messages), and supersedes a running one
+  until that one starts posting to the conversation (see release). The flag is
+  stored with the job, so this works across worker processes.
+- failed jobs are retried with backoff, then dead-lettered (status "dead")
+
+The database is shared by all worker processes, so queries run in a thread and
+wait for each other's locks there rather than on the event loop.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from termcolor import cprint
+
+import metrics
+
+load_dotenv()
+
+WORK_QUEUE_DB = os.getenv("WORK_QUEUE_DB", "work_queue.db")
+WORK_QUEUE_WORKERS = int(os.getenv("WORK_QUEUE_WORKERS", 4))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", 3))
+# on shutdown, wait this long for running jobs before putting them back
+WORK_QUEUE_SHUTDOWN_SECONDS = float(os.getenv("WORK_QUEUE_SHUTDOWN_SECONDS", 20))
+# how long a query waits for another process' write lock
+WORK_QUEUE_BUSY_TIMEOUT = float(os.getenv("WORK_QUEUE_BUSY_TIMEOUT", 30))
+# how often to look for jobs left running by a worker process that is gone
+WORK_QUEUE_RECOVER_SECONDS = float(os.getenv("WORK_QUEUE_RECOVER_SECONDS", 60))
+POLL_SECONDS = 1
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+
+QUEUED = "queued"
+RUNNING = "running"
+# posting to the conversation, can't be cancelled or safely retried
+ACTING = "acting"
+DEAD = "dead"
+
+# (job id, conversation id) of the job a task is running for
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class Superseded(Exception):
+    """
+    A newer job of the same conversation came in, this one must not post
+    """
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WorkQueue:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(
+            db_path,
+            timeout=WORK_QUEUE_BUSY_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        # one query at a time on the shared connection
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id TEXT NOT NULL, "
+            "payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, enqueued_at REAL NOT NULL, "
+            "available_at REAL NOT NULL, worker_pid INTEGER, last_error TEXT, "
+            "superseded INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "superseded" not in columns:
+            self.db.execute(
+                "ALTER TABLE jobs ADD COLUMN superseded INTEGER NOT NULL DEFAULT 0"
+            )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, available_at)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_jobs_conversation_id ON jobs (conversation_id)"
+        )
+        self.handler = None
+        self.workers = []
+        self.stopping = False
+        self.wake_up = None
+        self.recover_at = 0
+        # conversation id -> (job id, task) of running jobs, to cancel superseded
+        # ones of this process right away rather than on the next poll
+        self.running = {}
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run a function querying the database in a thread
+        """
+
+        def run_locked():
+            with self.lock:
+                return function(*args, **kwargs)
+
+        return await asyncio.to_thread(run_locked)
+
+    def query(self, sql, parameters=()):
+        # (fetch all so the statement completes and writes commit)
+        return self.db.execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    async def enqueue(self, conversation_id, payload, delay=0):
+        """
+        Queue a job to run after delay seconds, superseding a running job of the
+        conversation (in any process) that hasn't started posting yet
+        returns the payload of the conversation's job still waiting that it
+        replaced, None if there was none
+        """
+        conversation_id = str(conversation_id)
+
+        def insert():
+            now = time.time()
+            with self.transaction():
+                waiting = self.query(
+                    "SELECT id, payload FROM jobs WHERE conversation_id = ? "
+                    "AND status = ?",
+                    (conversation_id, QUEUED),
+                )
+                if waiting:
+                    self.query(
+                        "UPDATE jobs SET payload = ?, available_at = ?, attempts = 0 "
+                        "WHERE id = ?",
+                        (json.dumps(payload), now + delay, waiting[0][0]),
+                    )
+                else:
+                    self.query(
+                        "INSERT INTO jobs (conversation_id, payload, status, "
+                        "enqueued_at, available_at) VALUES (?, ?, ?, ?, ?)",
+                        (conversation_id, json.dumps(payload), QUEUED, now, now + delay),
+                    )
+                superseded = self.query(
+                    "UPDATE jobs SET superseded = 1 WHERE conversation_id = ? "
+                    "AND status = ? AND superseded = 0 RETURNING id",
+                    (conversation_id, RUNNING),
+                )
+            replaced = json.loads(waiting[0][1]) if waiting else None
+            return replaced, [row[0] for row in superseded]
+
+        replaced, superseded = await self.run(insert)
+        metrics.increment("work_queue_enqueued")
+        if replaced is not None:
+            metrics.increment("work_queue_coalesced")
+        if superseded:
+            cprint(f"Superseding previous job for {conversation_id}", "red")
+            metrics.increment("work_queue_cancelled")
+
+        # don't wait for the next poll if the outdated job runs in this process
+        running = self.running.get(conversation_id)
+        if running and running[0] in superseded and not running[1].done():
+            running[1].cancel()
+
+        await self.update_gauges()
+        if self.wake_up:
+            self.wake_up.set()
+        return replaced
+
+    async def release(self):
+        """
+        Called by a job once it starts posting to the conversation: from then on
+        newer jobs no longer supersede it, and it isn't retried if it fails.
+        Raises Superseded if a newer job already did.
+        """
+        job = current_job.get()
+        if job is None:
+            # not running from the queue
+            return
+        job_id, conversation_id = job
+        rows = await self.run(
+            self.query,
+            "UPDATE jobs SET status = ? WHERE id = ? AND status IN (?, ?) "
+            "AND superseded = 0 RETURNING id",
+            (ACTING, job_id, RUNNING, ACTING),
+        )
+        if not rows:
+            raise Superseded(f"job {job_id} of conversation {conversation_id}")
+        if self.running.get(conversation_id, (None,))[0] == job_id:
+            del self.running[conversation_id]
+
+    async def claim(self):
+        """
+        Take the next job that is due and whose conversation has no job running
+        """
+        rows = await self.run(
+            self.query,
+            "UPDATE jobs SET status = ?, worker_pid = ?, superseded = 0 WHERE id = ("
+            "SELECT id FROM jobs WHERE status = ? AND available_at <= ? "
+            "AND conversation_id NOT IN "
+            "(SELECT conversation_id FROM jobs WHERE status IN (?, ?)) "
+            "ORDER BY available_at, id LIMIT 1) "
+            "RETURNING id, conversation_id, payload, attempts, enqueued_at, available_at",
+            (RUNNING, os.getpid(), QUEUED, time.time(), RUNNING, ACTING),
+        )
+        return rows[0] if rows else None
+
+    def set_status(self, job_id, status, **columns):
+        assignments = "".join(f", {column} = ?" for column in columns)
+        self.query(
+            f"UPDATE jobs SET status = ?{assignments} WHERE id = ?",
+            (status, *columns.values(), job_id),
+        )
+
+    def delete(self, job_id):
+        self.query("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def get_job(self, job_id):
+        """
+        returns the status and superseded flag of a job, None if it is gone
+        """
+        rows = self.query("SELECT status, superseded FROM jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    async def next_available_in(self):
+        rows = await self.run(
+            self.query,
+            "SELECT MIN(available_at) FROM jobs WHERE status = ? "
+            "AND conversation_id NOT IN "
+            "(SELECT conversation_id FROM jobs WHERE status IN (?, ?))",
+            (QUEUED, RUNNING, ACTING),
+        )
+        if rows[0][0] is None:
+            return POLL_SECONDS
+        return min(POLL_SECONDS, max(0, rows[0][0] - time.time()))
+
+    async def update_gauges(self):
+        counts = dict(
+            await self.run(
+                self.query, "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            )
+        )
+        for status in [QUEUED, RUNNING, ACTING, DEAD]:
+            metrics.set_gauge(f"work_queue_{status}", counts.get(status, 0))
+
+    def recover(self, own_jobs=True):
+        """
+        Jobs left running by a process that is gone (e.g. killed by a deploy, or
+        a crashed worker process) are put back, see recover_job. own_jobs: also
+        the ones with this process' pid, left by an earlier process with the
+        same pid (on startup, e.g. pid 1 in a container).
+        """
+        rows = self.query(
+            "SELECT id, status, worker_pid, superseded FROM jobs "
+            "WHERE status IN (?, ?)",
+            (RUNNING, ACTING),
+        )
+        recovered = 0
+        for job_id, status, worker_pid, superseded in rows:
+            if worker_pid == os.getpid():
+                if not own_jobs:
+                    continue
+            elif worker_pid and pid_exists(worker_pid):
+                continue
+            recovered += 1
+            self.recover_job(job_id, status, superseded)
+        if recovered:
+            cprint(f"Recovered {recovered} interrupted jobs", "yellow")
+
+    def recover_job(self, job_id, status, superseded):
+        """
+        An interrupted job is queued again, or dead-lettered if it had started
+        posting. A superseded one is dropped, its newer job is queued already.
+        """
+        if status == RUNNING and superseded:
+            self.delete(job_id)
+        elif status == RUNNING:
+            self.set_status(job_id, QUEUED, worker_pid=None)
+            metrics.increment("work_queue_recovered")
+        else:
+            self.set_status(
+                job_id, DEAD, last_error="interrupted while posting to conversation"
+            )
+            metrics.increment("work_queue_dead")
+
+    def interrupt(self, job_id):
+        """
+        Put back a job this process stops running (shutting down), so other
+        processes don't skip its conversation until this one is restarted
+        """
+        with self.transaction():
+            job = self.get_job(job_id)
+            if job is not None:
+                self.recover_job(job_id, *job)
+
+    async def wait_superseded(self, job_id, task):
+        """
+        Wait for the task, cancelling it if a newer job (possibly of another
+        process) supersedes it before it starts posting
+        """
+        while not task.done():
+            await asyncio.wait([task], timeout=POLL_SECONDS)
+            if task.done():
+                break
+            job = await self.run(self.get_job, job_id)
+            if job and job[0] == RUNNING and job[1]:
+                task.cancel()
+
+    async def run_job(self, job):
+        job_id, conversation_id, payload, attempts, enqueued_at, available_at = job
+        now = time.time()
+        # waiting for a free worker (size the pool by this), and overall
+        metrics.observe("work_queue_wait", max(0, now - available_at))
+        metrics.observe("work_queue_latency", now - enqueued_at)
+        if not attempts:
+            # the enqueue delay, pushed back by every job it replaced
+            metrics.observe("coalesce_added_latency", available_at - enqueued_at)
+        token = current_job.set((job_id, conversation_id))
+        task = asyncio.create_task(self.handler(json.loads(payload)))
+        current_job.reset(token)
+        self.running[conversation_id] = (job_id, task)
+        start = time.perf_counter()
+        try:
+            try:
+                await self.wait_superseded(job_id, task)
+            except asyncio.CancelledError:
+                # shutting down
+                task.cancel()
+                raise
+            await task
+        except asyncio.CancelledError:
+            if self.stopping:
+                await self.run(self.interrupt, job_id)
+                raise
+            # superseded by a newer job of the same conversation
+            await self.run(self.delete, job_id)
+        except Superseded:
+            # (noticed when it was about to post)
+            await self.run(self.delete, job_id)
+        except Exception as e:
+            attempts += 1
+            cprint(f"Job {job_id} failed (attempt {attempts}): {e!r}", "red")
+            job = await self.run(self.get_job, job_id)
+            if job and job[0] == ACTING:
+                # retrying could post the same reply twice
+                await self.run(
+                    self.set_status, job_id, DEAD, attempts=attempts, last_error=repr(e)
+                )
+                metrics.increment("work_queue_dead")
+            elif attempts >= WORK_QUEUE_MAX_ATTEMPTS:
+                await self.run(
+                    self.set_status, job_id, DEAD, attempts=attempts, last_error=repr(e)
+                )
+                metrics.increment("work_queue_dead")
+            else:
+                backoff = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE**attempts))
+                await self.run(
+                    self.set_status,
+                    job_id,
+                    QUEUED,
+                    attempts=attempts,
+                    available_at=time.time() + backoff,
+                    worker_pid=None,
+                    last_error=repr(e),
+                )
+                metrics.increment("work_queue_retried")
+        else:
+            await self.run(self.delete, job_id)
+            metrics.increment("work_queue_completed")
+        finally:
+            metrics.observe("work_queue_run", time.perf_counter() - start)
+            if self.running.get(conversation_id, (None,))[0] == job_id:
+                del self.running[conversation_id]
+            if not self.stopping:
+                await self.update_gauges()
+            # the conversation's next job may be waiting on this one
+            self.wake_up.set()
+
+    async def work(self):
+        while not self.stopping:
+            if time.time() >= self.recover_at:
+                # (jobs of other worker processes, ours are running)
+                self.recover_at = time.time() + WORK_QUEUE_RECOVER_SECONDS
+                await self.run(self.recover, own_jobs=False)
+            job = await self.claim()
+            if job is None:
+                self.wake_up.clear()
+                try:
+                    await asyncio.wait_for(
+                        self.wake_up.wait(), await self.next_available_in()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.update_gauges()
+            await self.run_job(job)
+
+    async def start(self, handler, workers=WORK_QUEUE_WORKERS):
+        self.handler = handler
+        self.stopping = False
+        self.wake_up = asyncio.Event()
+        await self.run(self.recover)
+        self.recover_at = time.time() + WORK_QUEUE_RECOVER_SECONDS
+        await self.update_gauges()
+        self.workers = [asyncio.create_task(self.work()) for _ in range(workers)]
+
+    async def stop(self, timeout=WORK_QUEUE_SHUTDOWN_SECONDS):
+        """
+        Stop taking jobs and give running ones some time to finish
+        """
+        self.stopping = True
+        self.wake_up.set()
+        _, pending = await asyncio.wait(self.workers, timeout=timeout)
+        for worker in pending:
+            worker.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self.workers = []
+
+
+work_queue = WorkQueue(WORK_QUEUE_DB)